@@ -0,0 +1,401 @@
+#!/usr/bin/env python
+
+'''
+Benchmarks for the two hot paths: phone extraction
+(``dig.phone.matchphone.extractPhoneNumbers``) and the conversion of
+Karma mentions to FeatureCollections (``extract-mentions-features.py``).
+
+The corpora are synthetic, generated from a seed, so runs need no
+network and are repeatable: obfuscated phone texts in the styles of
+``dig/phone/data/test.txt``, Karma mention exports like
+``sample_aligned_data.json``, and long texts on which a phone scanner
+that re-searches after every rejected candidate turns quadratic.
+
+Each benchmark runs in its own process so that its peak RSS is its own.
+Results are written as JSON; ``--compare`` prints two such files side
+by side.
+'''
+
+from __future__ import absolute_import, division, print_function
+
+import argparse
+import imp
+import json
+import os
+import random
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+EXTRACT_SCRIPT = os.path.join(HERE, 'extract-mentions-features.py')
+
+sys.path.insert(0, HERE)
+from dig.phone import matchphone
+
+DIGIT_WORDS = ['zero', 'one', 'two', 'three', 'four',
+               'five', 'six', 'seven', 'eight', 'nine']
+LOOKALIKES = {'0': ['o', 'O', 'oh'], '1': ['l', 'i', 'I']}
+SEPARATORS = ['-', '.', ' ', '*', '**', '~', '/', '@', '', '_', '!']
+BRACKETS = [('(', ')'), ('[', ']'), ('{', '}'), ('((', '))'), ('<', '>')]
+FILLER = [
+    u"I'm 5'6\" 140 lbs. with a nice smile",
+    u'Available 24/7 *** INCALL SPECIALS',
+    u'Drop Dead Gorgeous with outgoing personality.',
+    u'specializing in Swedish Deep Tissue Massages.',
+    u'Incalls and outcalls to all areas. Outcalls are extra for travel.',
+    u'NO DIRTY TALK!! 100% REAL PICS ALL NATURAL!!!!!!!',
+    u'$200 hh $300 h, 2 girl special $400',
+    u'NO BLOCKED CALLS ACCEPTED 4 MORE Details in PICS',
+    u'new in town for 3 days only, 34C-24-36',
+    u'call me', u'text me at', u'ask for Mya',
+]
+
+NAMES = ['mya', 'bambi', 'rachel', 'jade', 'crystal', 'amber', 'destiny',
+         'star', 'cherry', 'diamond', 'kim', 'lola', 'nikki', 'roxy']
+FEATURE_VALUES = {
+    'PersonName': lambda rng: rng.choice(NAMES),
+    'ethnicity': lambda rng: rng.choice(['white', 'black', 'latina', 'asian',
+                                         'ebony', 'mixed']),
+    'hair': lambda rng: rng.choice(['blonde', 'brunette', 'red', 'black']),
+    'age': lambda rng: str(rng.randint(18, 45)),
+    'height': lambda rng: str(rng.randint(150, 185)),
+    'weight': lambda rng: str(rng.randint(100, 180)),
+    'cup': lambda rng: rng.choice(['a', 'b', 'c', 'd', 'dd']),
+    'build': lambda rng: rng.choice(['petite', 'slim', 'curvy', 'thick']),
+    'City': lambda rng: rng.choice(['atlanta', 'birmingham', 'houston',
+                                    'chicago', 'seattle', 'miami']),
+}
+
+
+def random_phone(rng, area_codes):
+    '''a plausible ten digit phone number'''
+    return '%s%d%02d%04d' % (rng.choice(area_codes), rng.randint(2, 9),
+                            rng.randint(0, 99), rng.randint(0, 9999))
+
+
+def obfuscate_digit(rng, digit):
+    r = rng.random()
+    if r < 0.55:
+        return digit
+    if r < 0.85:
+        word = DIGIT_WORDS[int(digit)]
+        return rng.choice([word, word.upper(), word.capitalize()])
+    return rng.choice(LOOKALIKES.get(digit, [digit]))
+
+
+def obfuscate_phone(rng, digits):
+    '''digits written the way ads hide them from scrapers'''
+    groups = [digits[0:3], digits[3:6], digits[6:10]]
+    if rng.random() < 0.3:
+        # one separator between every digit, e.g. 5@7@4@4@...
+        sep = rng.choice(SEPARATORS)
+        return sep.join(obfuscate_digit(rng, d) for d in digits)
+    parts = [''.join(obfuscate_digit(rng, d) for d in group)
+             for group in groups]
+    if rng.random() < 0.3:
+        opening, closing = rng.choice(BRACKETS)
+        parts = [opening + part + closing for part in parts]
+    text = rng.choice(SEPARATORS).join(parts)
+    if rng.random() < 0.05:
+        text = '*82' + text
+    return text
+
+
+def synthetic_phone_text(rng, area_codes):
+    '''an ad body: filler with zero to two obfuscated phone numbers'''
+    pieces = [rng.choice(FILLER) for _ in range(rng.randint(1, 8))]
+    for _ in range(rng.choice([0, 1, 1, 1, 2])):
+        phone = obfuscate_phone(rng, random_phone(rng, area_codes))
+        pieces.insert(rng.randint(0, len(pieces)), phone)
+    return u' '.join(pieces)
+
+
+def synthetic_phone_texts(seed, count):
+    rng = random.Random(seed)
+    (index, rows) = matchphone.areaCodes()
+    area_codes = [row.id for row in rows]
+    return [synthetic_phone_text(rng, area_codes) for _ in range(count)]
+
+
+def adversarial_phone_texts(size):
+    '''
+    (name, text) pairs of about size characters on which the reference
+    scanner, ``matchphone.genPhonesRegexp``, degrades
+    '''
+    return [('rejected after long gap', 'x' * size + '911 555 1212'),
+            ('invalid digit run', ('9' * 10 + ' ') * (size // 11)),
+            ('separated invalid run', '9-1-1-' * (size // 6)),
+            ('*82 run', '*82' * (size // 3)),
+            ('valid run', '2125551212' * (size // 10))]
+
+
+def synthetic_karma_item(rng, area_codes, serial):
+    crawl = '%040x-%d' % (rng.getrandbits(160), 1396486522000 + serial)
+    features = [('PhoneNumber', random_phone(rng, area_codes))
+                for _ in range(rng.randint(0, 2))]
+    for _ in range(rng.randint(0, 6)):
+        featname = rng.choice(sorted(FEATURE_VALUES))
+        features.append((featname, FEATURE_VALUES[featname](rng)))
+    item = {
+        'schema:url': 'http://www.example.com/escorts/%d.html' % serial,
+        '@type': 'http://schema.org/WebPage',
+        '@id': 'http://memexproxy.com/data/crawl/%s' % crawl,
+    }
+    mentions = [{
+        '@type': 'http://memexproxy.com/ontology/Mention',
+        'memex:feature': 'http://memexproxy.com/data/%s/%s' % feature,
+        '@id': 'http://memexproxy.com/data/mention/%s/%s/crawl/%s'
+               % (feature + (crawl,)),
+        'prov:wasGeneratedBy':
+            'http://memexproxy.com/data/extractor/ist/version01',
+    } for feature in features]
+    if len(mentions) == 1:
+        item['schema:mentions'] = mentions[0]
+    elif mentions:
+        item['schema:mentions'] = mentions
+    return item
+
+
+def write_karma_export(seed, count, path, jsonlines=False):
+    '''
+    Writes a synthetic karma export of count items to path, as a json
+    array or as json lines
+    '''
+    rng = random.Random(seed)
+    (index, rows) = matchphone.areaCodes()
+    area_codes = [row.id for row in rows]
+    with open(path, 'w') as f:
+        if not jsonlines:
+            f.write('[\n')
+        for serial in range(count):
+            item = json.dumps(synthetic_karma_item(rng, area_codes, serial))
+            if jsonlines:
+                f.write(item + '\n')
+            else:
+                f.write(item + (',\n' if serial < count - 1 else '\n'))
+        if not jsonlines:
+            f.write(']\n')
+
+
+def load_extract_script():
+    return imp.load_source('extract_mentions_features', EXTRACT_SCRIPT)
+
+
+def percentile(sorted_values, p):
+    if not sorted_values:
+        return None
+    k = int(round(p / 100 * (len(sorted_values) - 1)))
+    return sorted_values[k]
+
+
+def summarize(count, elapsed, latencies=None):
+    result = {'docs': count, 'seconds': elapsed,
+              'docs_per_sec': count / elapsed if elapsed else None}
+    if latencies is not None:
+        latencies = sorted(latencies)
+        result['p50_ms'] = percentile(latencies, 50) * 1000
+        result['p99_ms'] = percentile(latencies, 99) * 1000
+    return result
+
+
+def bench_extract_phones(args, workdir):
+    texts = synthetic_phone_texts(args.seed, args.phones)
+    latencies = []
+    start = time.time()
+    for text in texts:
+        t0 = time.time()
+        matchphone.extractPhoneNumbers(text)
+        latencies.append(time.time() - t0)
+    return summarize(len(texts), time.time() - start, latencies)
+
+
+def bench_scan_phones(args, workdir):
+    texts = [text for name, text in adversarial_phone_texts(args.scan_size)]
+    latencies = []
+    start = time.time()
+    for text in texts:
+        t0 = time.time()
+        for phone in matchphone.genPhones(text):
+            pass
+        latencies.append(time.time() - t0)
+    return summarize(len(texts), time.time() - start, latencies)
+
+
+def bench_group_mentions(args, workdir):
+    path = os.path.join(workdir, 'karma.json')
+    write_karma_export(args.seed, args.ads, path)
+    script = load_extract_script()
+
+    class ItemStats(script.PipelineStats):
+        '''
+        Also keeps the seconds of each item group_mentions_as_features
+        gets through timed: from asking for it to asking for the next,
+        parsing it and adding it to the store
+        '''
+        def __init__(self):
+            super(ItemStats, self).__init__()
+            self.latencies = []
+
+        def timed(self, stage, iterable):
+            start = time.time()
+            for item in super(ItemStats, self).timed(stage, iterable):
+                yield item
+                now = time.time()
+                self.latencies.append(now - start)
+                start = now
+
+    stats = ItemStats()
+    start = time.time()
+    with open(path) as f:
+        grouped = script.group_mentions_as_features(f, stats)
+    elapsed = time.time() - start
+    if not stats.latencies:
+        raise RuntimeError('group_mentions_as_features timed no items')
+    return summarize(len(grouped), elapsed, stats.latencies)
+
+
+def bench_stream_mentions(args, workdir):
+    path = os.path.join(workdir, 'karma.json')
+    write_karma_export(args.seed, args.ads, path)
+    script = load_extract_script()
+    latencies = []
+    start = time.time()
+    with open(path) as f:
+        ads = script.gen_mentions_as_features(f)
+        while True:
+            t0 = time.time()
+            if next(ads, None) is None:
+                break
+            latencies.append(time.time() - t0)
+    return summarize(len(latencies), time.time() - start, latencies)
+
+
+def bench_pipeline(args, workdir):
+    path = os.path.join(workdir, 'karma.json')
+    write_karma_export(args.seed, args.ads, path)
+    with open(path) as f:
+        ads = sum(1 for _ in load_extract_script().gen_mentions_as_features(f))
+    stats_path = os.path.join(workdir, 'stats.json')
+    cmd = [sys.executable, EXTRACT_SCRIPT, '--transforms', 'features',
+           '--transforms', 'display', '--stats-output', stats_path,
+           path, os.path.join(workdir, 'out.fc')]
+    start = time.time()
+    # the summary --stats-output also prints would garble the results
+    with open(os.path.join(workdir, 'stderr'), 'w+') as ferr:
+        if subprocess.call(cmd, stderr=ferr):
+            ferr.seek(0)
+            raise RuntimeError(ferr.read()[-1000:])
+    result = summarize(ads, time.time() - start)
+    with open(stats_path) as f:
+        latency = json.load(f)['ad_latency_us']
+    # the child's percentiles are the upper bounds of its latency buckets
+    for p in ['p50', 'p99']:
+        if latency[p] is not None:
+            result[p + '_ms'] = latency[p] / 1000
+    result['child_peak_rss_kb'] = \
+        resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    return result
+
+
+BENCHMARKS = [
+    ('extract_phones', bench_extract_phones),
+    ('scan_phones', bench_scan_phones),
+    ('group_mentions', bench_group_mentions),
+    ('stream_mentions', bench_stream_mentions),
+    ('pipeline', bench_pipeline),
+]
+
+
+def run_one(name, args):
+    '''runs one benchmark in this process'''
+    workdir = tempfile.mkdtemp(prefix='dig-bench-')
+    try:
+        result = dict(BENCHMARKS)[name](args, workdir)
+    except Exception as e:
+        result = {'error': '%s: %s' % (type(e).__name__, e)}
+    finally:
+        shutil.rmtree(workdir)
+    result['peak_rss_kb'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return result
+
+
+def run_all(args):
+    '''runs each benchmark in a fresh process'''
+    results = {'seed': args.seed, 'phones': args.phones, 'ads': args.ads,
+               'scan_size': args.scan_size,
+               'python': sys.version.split()[0], 'time': time.time(),
+               'benchmarks': {}}
+    for name, _ in BENCHMARKS:
+        if args.only and name not in args.only:
+            continue
+        cmd = [sys.executable, os.path.abspath(__file__), '--run', name,
+               '--seed', str(args.seed), '--phones', str(args.phones),
+               '--ads', str(args.ads), '--scan-size', str(args.scan_size)]
+        results['benchmarks'][name] = json.loads(
+            subprocess.check_output(cmd).decode('utf-8'))
+    return results
+
+
+def print_results(results):
+    for name, result in sorted(results['benchmarks'].items()):
+        if 'error' in result:
+            print('%-16s %s' % (name, result['error']))
+            continue
+        print('%-16s %10.1f docs/s  p50 %8s ms  p99 %8s ms  rss %8d kB'
+              % (name, result['docs_per_sec'] or 0,
+                 '%.3f' % result['p50_ms'] if 'p50_ms' in result else '-',
+                 '%.3f' % result['p99_ms'] if 'p99_ms' in result else '-',
+                 result.get('child_peak_rss_kb', result['peak_rss_kb'])))
+
+
+def compare(base, new):
+    '''prints new against base, as ratios new / base'''
+    metrics = ['docs_per_sec', 'p50_ms', 'p99_ms', 'peak_rss_kb',
+               'child_peak_rss_kb']
+    for name in sorted(set(base['benchmarks']) | set(new['benchmarks'])):
+        old_result = base['benchmarks'].get(name, {})
+        new_result = new['benchmarks'].get(name, {})
+        for metric in metrics:
+            a, b = old_result.get(metric), new_result.get(metric)
+            if a is None and b is None:
+                continue
+            ratio = '%.2fx' % (b / a) if a and b is not None else '-'
+            print('%-16s %-18s %12s %12s %8s'
+                  % (name, metric, '%.3f' % a if a is not None else '-',
+                     '%.3f' % b if b is not None else '-', ratio))
+
+
+if __name__ == '__main__':
+    p = argparse.ArgumentParser(
+        description='Benchmark phone extraction and FC conversion.')
+    p.add_argument('--phones', type=int, default=20000,
+                   help='number of synthetic phone texts')
+    p.add_argument('--ads', type=int, default=20000,
+                   help='number of ads in the synthetic karma export')
+    p.add_argument('--scan-size', type=int, default=100000,
+                   help='characters of each adversarial phone text')
+    p.add_argument('--seed', type=int, default=0)
+    p.add_argument('--only', action='append',
+                   choices=[name for name, _ in BENCHMARKS])
+    p.add_argument('--output', metavar='JSON_FILE',
+                   help='write the results here')
+    p.add_argument('--compare', nargs=2, metavar=('BASE_JSON', 'NEW_JSON'),
+                   help='compare two result files and quit')
+    p.add_argument('--run', help=argparse.SUPPRESS)
+    args = p.parse_args()
+
+    if args.compare:
+        with open(args.compare[0]) as fbase, open(args.compare[1]) as fnew:
+            compare(json.load(fbase), json.load(fnew))
+    elif args.run:
+        print(json.dumps(run_one(args.run, args)))
+    else:
+        results = run_all(args)
+        print_results(results)
+        if args.output:
+            with open(args.output, 'w') as f:
+                json.dump(results, f, indent=2, sort_keys=True)
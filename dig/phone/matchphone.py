@@ -17,26 +17,68 @@ Options:
 '''
 
 import sys
+import os
 import re
 import csv
+import hashlib
+import sqlite3
 import argparse
-
-AREA_CODES= set()
-
-with open('area_code.tsv') as tsv:
-    for row in csv.reader(tsv, delimiter="\t"):
-        (id, adm1_abbrev, adm1_name, cities, iso3166_a2_code, country_id) = row
-        AREA_CODES.add(int(id))
+import collections
+import itertools
+import json
+import multiprocessing
 
 VERSION = '2.5'
 REVISION = "$Revision: 24407 $".replace("$","")
 VERBOSE = True
 
+DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data')
+AREA_CODE_TSV = os.path.join(DATA_DIR, 'area_code.tsv')
+
+AreaCode = collections.namedtuple('AreaCode',
+                                  ['id', 'adm1_abbrev', 'adm1_name', 'cities', 'iso3166_a2_code', 'country_id'])
+
+# loaded on first use by areaCodes():
+# AREA_CODE_INDEX maps the 3 digits of each area code to 1 + its position in AREA_CODE_ROWS
+AREA_CODE_INDEX = None
+AREA_CODE_ROWS = None
+
+def readAreaCodeTsv(path=AREA_CODE_TSV):
+    with open(path) as tsv:
+        return [tuple(row) for row in csv.reader(tsv, delimiter="\t")]
+
+def indexAreaCodes(rows):
+    return dict((row[0], i + 1) for (i, row) in enumerate(rows))
+
+def areaCodes():
+    '''(AREA_CODE_INDEX, AREA_CODE_ROWS), loading them on first use'''
+    global AREA_CODE_INDEX, AREA_CODE_ROWS
+    if AREA_CODE_INDEX is None:
+        rows = readAreaCodeTsv()
+        AREA_CODE_ROWS = [AreaCode(*row) for row in rows]
+        AREA_CODE_INDEX = indexAreaCodes(rows)
+    return (AREA_CODE_INDEX, AREA_CODE_ROWS)
+
+def areaCodePosition(ac):
+    '''1 + the position in AREA_CODE_ROWS of area code ac, or 0 if it is not valid'''
+    (index, rows) = areaCodes()
+    position = index.get(ac)
+    if position is None:
+        # not 3 digits of the table: 212, '0212', ...
+        try:
+            code = int(ac)
+        except (TypeError, ValueError):
+            return 0
+        position = index.get('%03d' % code, 0) if 0 <= code < 1000 else 0
+    return position
+
+def areaCodeInfo(ac):
+    '''the AreaCode row (region, country, ...) of area code ac, or None'''
+    i = areaCodePosition(ac)
+    return AREA_CODE_ROWS[i-1] if i else None
+
 def validAreaCode(ac):
-    try:
-        return int(ac) in AREA_CODES
-    except:
-        return False
+    return areaCodePosition(ac) != 0
 
 def validPhoneNumber(ph, testAreaCode=True):
     m = re.search(r"""^[2-9]\d{2}[2-9]\d{6}$""", ph)
@@ -48,227 +90,200 @@ def validPhoneNumber(ph, testAreaCode=True):
     else:
         return False
 
-def cleanPhoneText(text):
-    text = text.lower()
-    
+# the normalization table: ordered (pattern, replacement) pairs, applied
+# case-insensitively one after another to the lowercased text
+
+ENTITY_SUBSTITUTIONS = [
     # simply remove numeric entities
-    text = re.sub(r"""&#\d{1,3};""", "", text, flags=re.I)
+    (r"""&#\d{1,3};""", ""),
+]
 
-    # re.sub(pattern,replacement,string, flags=re.I | re.G)
+TENS = ['twenty', 'thirty', 'forty', 'fifty', 'sixty', 'seventy', 'eighty', 'ninety']
+UNITS = ['one', 'two', 'three', 'four', 'five', 'six', 'seven', 'eight', 'nine']
 
+NUMERAL_SUBSTITUTIONS = [
     # misspelled numeral words 
-    text = re.sub(r"""th0usand""", "thousand", text, flags=re.I)
-    text = re.sub(r"""th1rteen""", "thirteen", text, flags=re.I)
-    text = re.sub(r"""f0urteen""", "fourteen", text, flags=re.I)
-    text = re.sub(r"""e1ghteen""", "eighteen", text, flags=re.I)
-    text = re.sub(r"""n1neteen""", "nineteen", text, flags=re.I)
-    text = re.sub(r"""f1fteen""", "fifteen", text, flags=re.I)
-    text = re.sub(r"""s1xteen""", "sixteen", text, flags=re.I)
-    text = re.sub(r"""th1rty""", "thirty", text, flags=re.I)
-    text = re.sub(r"""e1ghty""", "eighty", text, flags=re.I)
-    text = re.sub(r"""n1nety""", "ninety", text, flags=re.I)
-    text = re.sub(r"""fourty""", "forty", text, flags=re.I)
-    text = re.sub(r"""f0urty""", "forty", text, flags=re.I)
-    text = re.sub(r"""e1ght""", "eight", text, flags=re.I)
-    text = re.sub(r"""f0rty""", "forty", text, flags=re.I)
-    text = re.sub(r"""f1fty""", "fifty", text, flags=re.I)
-    text = re.sub(r"""s1xty""", "sixty", text, flags=re.I)
-    text = re.sub(r"""zer0""", "zero", text, flags=re.I)
-    text = re.sub(r"""f0ur""", "four", text, flags=re.I)
-    text = re.sub(r"""f1ve""", "five", text, flags=re.I)
-    text = re.sub(r"""n1ne""", "nine", text, flags=re.I)
-    text = re.sub(r"""0ne""", "one", text, flags=re.I)
-    text = re.sub(r"""tw0""", "two", text, flags=re.I)
-    text = re.sub(r"""s1x""", "six", text, flags=re.I)
+    (r"""th0usand""", "thousand"),
+    (r"""th1rteen""", "thirteen"),
+    (r"""f0urteen""", "fourteen"),
+    (r"""e1ghteen""", "eighteen"),
+    (r"""n1neteen""", "nineteen"),
+    (r"""f1fteen""", "fifteen"),
+    (r"""s1xteen""", "sixteen"),
+    (r"""th1rty""", "thirty"),
+    (r"""e1ghty""", "eighty"),
+    (r"""n1nety""", "ninety"),
+    (r"""fourty""", "forty"),
+    (r"""f0urty""", "forty"),
+    (r"""e1ght""", "eight"),
+    (r"""f0rty""", "forty"),
+    (r"""f1fty""", "fifty"),
+    (r"""s1xty""", "sixty"),
+    (r"""zer0""", "zero"),
+    (r"""f0ur""", "four"),
+    (r"""f1ve""", "five"),
+    (r"""n1ne""", "nine"),
+    (r"""0ne""", "one"),
+    (r"""tw0""", "two"),
+    (r"""s1x""", "six"),
+    ] + [
     # mixed compound numeral words
     # consider 7teen, etc.
-    text = re.sub(r"""twenty[\\W_]{0,3}1""", "twenty-one", text, flags=re.I)
-    text = re.sub(r"""twenty[\\W_]{0,3}2""", "twenty-two", text, flags=re.I)
-    text = re.sub(r"""twenty[\\W_]{0,3}3""", "twenty-three", text, flags=re.I)
-    text = re.sub(r"""twenty[\\W_]{0,3}4""", "twenty-four", text, flags=re.I)
-    text = re.sub(r"""twenty[\\W_]{0,3}5""", "twenty-five", text, flags=re.I)
-    text = re.sub(r"""twenty[\\W_]{0,3}6""", "twenty-six", text, flags=re.I)
-    text = re.sub(r"""twenty[\\W_]{0,3}7""", "twenty-seven", text, flags=re.I)
-    text = re.sub(r"""twenty[\\W_]{0,3}8""", "twenty-eight", text, flags=re.I)
-    text = re.sub(r"""twenty[\\W_]{0,3}9""", "twenty-nine", text, flags=re.I)
-    text = re.sub(r"""thirty[\\W_]{0,3}1""", "thirty-one", text, flags=re.I)
-    text = re.sub(r"""thirty[\\W_]{0,3}2""", "thirty-two", text, flags=re.I)
-    text = re.sub(r"""thirty[\\W_]{0,3}3""", "thirty-three", text, flags=re.I)
-    text = re.sub(r"""thirty[\\W_]{0,3}4""", "thirty-four", text, flags=re.I)
-    text = re.sub(r"""thirty[\\W_]{0,3}5""", "thirty-five", text, flags=re.I)
-    text = re.sub(r"""thirty[\\W_]{0,3}6""", "thirty-six", text, flags=re.I)
-    text = re.sub(r"""thirty[\\W_]{0,3}7""", "thirty-seven", text, flags=re.I)
-    text = re.sub(r"""thirty[\\W_]{0,3}8""", "thirty-eight", text, flags=re.I)
-    text = re.sub(r"""thirty[\\W_]{0,3}9""", "thirty-nine", text, flags=re.I)
-    text = re.sub(r"""forty[\\W_]{0,3}1""", "forty-one", text, flags=re.I)
-    text = re.sub(r"""forty[\\W_]{0,3}2""", "forty-two", text, flags=re.I)
-    text = re.sub(r"""forty[\\W_]{0,3}3""", "forty-three", text, flags=re.I)
-    text = re.sub(r"""forty[\\W_]{0,3}4""", "forty-four", text, flags=re.I)
-    text = re.sub(r"""forty[\\W_]{0,3}5""", "forty-five", text, flags=re.I)
-    text = re.sub(r"""forty[\\W_]{0,3}6""", "forty-six", text, flags=re.I)
-    text = re.sub(r"""forty[\\W_]{0,3}7""", "forty-seven", text, flags=re.I)
-    text = re.sub(r"""forty[\\W_]{0,3}8""", "forty-eight", text, flags=re.I)
-    text = re.sub(r"""forty[\\W_]{0,3}9""", "forty-nine", text, flags=re.I)
-    text = re.sub(r"""fifty[\\W_]{0,3}1""", "fifty-one", text, flags=re.I)
-    text = re.sub(r"""fifty[\\W_]{0,3}2""", "fifty-two", text, flags=re.I)
-    text = re.sub(r"""fifty[\\W_]{0,3}3""", "fifty-three", text, flags=re.I)
-    text = re.sub(r"""fifty[\\W_]{0,3}4""", "fifty-four", text, flags=re.I)
-    text = re.sub(r"""fifty[\\W_]{0,3}5""", "fifty-five", text, flags=re.I)
-    text = re.sub(r"""fifty[\\W_]{0,3}6""", "fifty-six", text, flags=re.I)
-    text = re.sub(r"""fifty[\\W_]{0,3}7""", "fifty-seven", text, flags=re.I)
-    text = re.sub(r"""fifty[\\W_]{0,3}8""", "fifty-eight", text, flags=re.I)
-    text = re.sub(r"""fifty[\\W_]{0,3}9""", "fifty-nine", text, flags=re.I)
-    text = re.sub(r"""sixty[\\W_]{0,3}1""", "sixty-one", text, flags=re.I)
-    text = re.sub(r"""sixty[\\W_]{0,3}2""", "sixty-two", text, flags=re.I)
-    text = re.sub(r"""sixty[\\W_]{0,3}3""", "sixty-three", text, flags=re.I)
-    text = re.sub(r"""sixty[\\W_]{0,3}4""", "sixty-four", text, flags=re.I)
-    text = re.sub(r"""sixty[\\W_]{0,3}5""", "sixty-five", text, flags=re.I)
-    text = re.sub(r"""sixty[\\W_]{0,3}6""", "sixty-six", text, flags=re.I)
-    text = re.sub(r"""sixty[\\W_]{0,3}7""", "sixty-seven", text, flags=re.I)
-    text = re.sub(r"""sixty[\\W_]{0,3}8""", "sixty-eight", text, flags=re.I)
-    text = re.sub(r"""sixty[\\W_]{0,3}9""", "sixty-nine", text, flags=re.I)
-    text = re.sub(r"""seventy[\\W_]{0,3}1""", "seventy-one", text, flags=re.I)
-    text = re.sub(r"""seventy[\\W_]{0,3}2""", "seventy-two", text, flags=re.I)
-    text = re.sub(r"""seventy[\\W_]{0,3}3""", "seventy-three", text, flags=re.I)
-    text = re.sub(r"""seventy[\\W_]{0,3}4""", "seventy-four", text, flags=re.I)
-    text = re.sub(r"""seventy[\\W_]{0,3}5""", "seventy-five", text, flags=re.I)
-    text = re.sub(r"""seventy[\\W_]{0,3}6""", "seventy-six", text, flags=re.I)
-    text = re.sub(r"""seventy[\\W_]{0,3}7""", "seventy-seven", text, flags=re.I)
-    text = re.sub(r"""seventy[\\W_]{0,3}8""", "seventy-eight", text, flags=re.I)
-    text = re.sub(r"""seventy[\\W_]{0,3}9""", "seventy-nine", text, flags=re.I)
-    text = re.sub(r"""eighty[\\W_]{0,3}1""", "eighty-one", text, flags=re.I)
-    text = re.sub(r"""eighty[\\W_]{0,3}2""", "eighty-two", text, flags=re.I)
-    text = re.sub(r"""eighty[\\W_]{0,3}3""", "eighty-three", text, flags=re.I)
-    text = re.sub(r"""eighty[\\W_]{0,3}4""", "eighty-four", text, flags=re.I)
-    text = re.sub(r"""eighty[\\W_]{0,3}5""", "eighty-five", text, flags=re.I)
-    text = re.sub(r"""eighty[\\W_]{0,3}6""", "eighty-six", text, flags=re.I)
-    text = re.sub(r"""eighty[\\W_]{0,3}7""", "eighty-seven", text, flags=re.I)
-    text = re.sub(r"""eighty[\\W_]{0,3}8""", "eighty-eight", text, flags=re.I)
-    text = re.sub(r"""eighty[\\W_]{0,3}9""", "eighty-nine", text, flags=re.I)
-    text = re.sub(r"""ninety[\\W_]{0,3}1""", "ninety-one", text, flags=re.I)
-    text = re.sub(r"""ninety[\\W_]{0,3}2""", "ninety-two", text, flags=re.I)
-    text = re.sub(r"""ninety[\\W_]{0,3}3""", "ninety-three", text, flags=re.I)
-    text = re.sub(r"""ninety[\\W_]{0,3}4""", "ninety-four", text, flags=re.I)
-    text = re.sub(r"""ninety[\\W_]{0,3}5""", "ninety-five", text, flags=re.I)
-    text = re.sub(r"""ninety[\\W_]{0,3}6""", "ninety-six", text, flags=re.I)
-    text = re.sub(r"""ninety[\\W_]{0,3}7""", "ninety-seven", text, flags=re.I)
-    text = re.sub(r"""ninety[\\W_]{0,3}8""", "ninety-eight", text, flags=re.I)
-    text = re.sub(r"""ninety[\\W_]{0,3}9""", "ninety-nine", text, flags=re.I)
+    (r"""%s[\\W_]{0,3}%d""" % (tens, u+1), "%s-%s" % (tens, unit))
+    for tens in TENS for (u, unit) in enumerate(UNITS)
+    ] + [
     # now resolve compound numeral words
     # allow twenty-one, twentyone, twenty_one, twenty one
-    text = re.sub(r"""twenty[ _-]?one""", "21", text, flags=re.I)
-    text = re.sub(r"""twenty[ _-]?two""", "22", text, flags=re.I)
-    text = re.sub(r"""twenty[ _-]?three""", "23", text, flags=re.I)
-    text = re.sub(r"""twenty[ _-]?four""", "24", text, flags=re.I)
-    text = re.sub(r"""twenty[ _-]?five""", "25", text, flags=re.I)
-    text = re.sub(r"""twenty[ _-]?six""", "26", text, flags=re.I)
-    text = re.sub(r"""twenty[ _-]?seven""", "27", text, flags=re.I)
-    text = re.sub(r"""twenty[ _-]?eight""", "28", text, flags=re.I)
-    text = re.sub(r"""twenty[ _-]?nine""", "29", text, flags=re.I)
-    text = re.sub(r"""thirty[ _-]?one""", "31", text, flags=re.I)
-    text = re.sub(r"""thirty[ _-]?two""", "32", text, flags=re.I)
-    text = re.sub(r"""thirty[ _-]?three""", "33", text, flags=re.I)
-    text = re.sub(r"""thirty[ _-]?four""", "34", text, flags=re.I)
-    text = re.sub(r"""thirty[ _-]?five""", "35", text, flags=re.I)
-    text = re.sub(r"""thirty[ _-]?six""", "36", text, flags=re.I)
-    text = re.sub(r"""thirty[ _-]?seven""", "37", text, flags=re.I)
-    text = re.sub(r"""thirty[ _-]?eight""", "38", text, flags=re.I)
-    text = re.sub(r"""thirty[ _-]?nine""", "39", text, flags=re.I)
-    text = re.sub(r"""forty[ _-]?one""", "41", text, flags=re.I)
-    text = re.sub(r"""forty[ _-]?two""", "42", text, flags=re.I)
-    text = re.sub(r"""forty[ _-]?three""", "43", text, flags=re.I)
-    text = re.sub(r"""forty[ _-]?four""", "44", text, flags=re.I)
-    text = re.sub(r"""forty[ _-]?five""", "45", text, flags=re.I)
-    text = re.sub(r"""forty[ _-]?six""", "46", text, flags=re.I)
-    text = re.sub(r"""forty[ _-]?seven""", "47", text, flags=re.I)
-    text = re.sub(r"""forty[ _-]?eight""", "48", text, flags=re.I)
-    text = re.sub(r"""forty[ _-]?nine""", "49", text, flags=re.I)
-    text = re.sub(r"""fifty[ _-]?one""", "51", text, flags=re.I)
-    text = re.sub(r"""fifty[ _-]?two""", "52", text, flags=re.I)
-    text = re.sub(r"""fifty[ _-]?three""", "53", text, flags=re.I)
-    text = re.sub(r"""fifty[ _-]?four""", "54", text, flags=re.I)
-    text = re.sub(r"""fifty[ _-]?five""", "55", text, flags=re.I)
-    text = re.sub(r"""fifty[ _-]?six""", "56", text, flags=re.I)
-    text = re.sub(r"""fifty[ _-]?seven""", "57", text, flags=re.I)
-    text = re.sub(r"""fifty[ _-]?eight""", "58", text, flags=re.I)
-    text = re.sub(r"""fifty[ _-]?nine""", "59", text, flags=re.I)
-    text = re.sub(r"""sixty[ _-]?one""", "61", text, flags=re.I)
-    text = re.sub(r"""sixty[ _-]?two""", "62", text, flags=re.I)
-    text = re.sub(r"""sixty[ _-]?three""", "63", text, flags=re.I)
-    text = re.sub(r"""sixty[ _-]?four""", "64", text, flags=re.I)
-    text = re.sub(r"""sixty[ _-]?five""", "65", text, flags=re.I)
-    text = re.sub(r"""sixty[ _-]?six""", "66", text, flags=re.I)
-    text = re.sub(r"""sixty[ _-]?seven""", "67", text, flags=re.I)
-    text = re.sub(r"""sixty[ _-]?eight""", "68", text, flags=re.I)
-    text = re.sub(r"""sixty[ _-]?nine""", "69", text, flags=re.I)
-    text = re.sub(r"""seventy[ _-]?one""", "71", text, flags=re.I)
-    text = re.sub(r"""seventy[ _-]?two""", "72", text, flags=re.I)
-    text = re.sub(r"""seventy[ _-]?three""", "73", text, flags=re.I)
-    text = re.sub(r"""seventy[ _-]?four""", "74", text, flags=re.I)
-    text = re.sub(r"""seventy[ _-]?five""", "75", text, flags=re.I)
-    text = re.sub(r"""seventy[ _-]?six""", "76", text, flags=re.I)
-    text = re.sub(r"""seventy[ _-]?seven""", "77", text, flags=re.I)
-    text = re.sub(r"""seventy[ _-]?eight""", "78", text, flags=re.I)
-    text = re.sub(r"""seventy[ _-]?nine""", "79", text, flags=re.I)
-    text = re.sub(r"""eighty[ _-]?one""", "81", text, flags=re.I)
-    text = re.sub(r"""eighty[ _-]?two""", "82", text, flags=re.I)
-    text = re.sub(r"""eighty[ _-]?three""", "83", text, flags=re.I)
-    text = re.sub(r"""eighty[ _-]?four""", "84", text, flags=re.I)
-    text = re.sub(r"""eighty[ _-]?five""", "85", text, flags=re.I)
-    text = re.sub(r"""eighty[ _-]?six""", "86", text, flags=re.I)
-    text = re.sub(r"""eighty[ _-]?seven""", "87", text, flags=re.I)
-    text = re.sub(r"""eighty[ _-]?eight""", "88", text, flags=re.I)
-    text = re.sub(r"""eighty[ _-]?nine""", "89", text, flags=re.I)
-    text = re.sub(r"""ninety[ _-]?one""", "91", text, flags=re.I)
-    text = re.sub(r"""ninety[ _-]?two""", "92", text, flags=re.I)
-    text = re.sub(r"""ninety[ _-]?three""", "93", text, flags=re.I)
-    text = re.sub(r"""ninety[ _-]?four""", "94", text, flags=re.I)
-    text = re.sub(r"""ninety[ _-]?five""", "95", text, flags=re.I)
-    text = re.sub(r"""ninety[ _-]?six""", "96", text, flags=re.I)
-    text = re.sub(r"""ninety[ _-]?seven""", "97", text, flags=re.I)
-    text = re.sub(r"""ninety[ _-]?eight""", "98", text, flags=re.I)
-    text = re.sub(r"""ninety[ _-]?nine""", "99", text, flags=re.I)
+    (r"""%s[ _-]?%s""" % (tens, unit), "%d" % (10*(t+2) + u+1))
+    for (t, tens) in enumerate(TENS) for (u, unit) in enumerate(UNITS)
+    ] + [
     # larger units function as suffixes now
     # assume never have three hundred four, three hundred and four
-    text = re.sub(r"""hundred""", "00", text, flags=re.I)
-    text = re.sub(r"""thousand""", "000", text, flags=re.I)
+    (r"""hundred""", "00"),
+    (r"""thousand""", "000"),
     # single numeral words now
     # some would have been ambiguous
-    text = re.sub(r"""seventeen""", "17", text, flags=re.I)
-    text = re.sub(r"""thirteen""", "13", text, flags=re.I)
-    text = re.sub(r"""fourteen""", "14", text, flags=re.I)
-    text = re.sub(r"""eighteen""", "18", text, flags=re.I)
-    text = re.sub(r"""nineteen""", "19", text, flags=re.I)
-    text = re.sub(r"""fifteen""", "15", text, flags=re.I)
-    text = re.sub(r"""sixteen""", "16", text, flags=re.I)
-    text = re.sub(r"""seventy""", "70", text, flags=re.I)
-    text = re.sub(r"""eleven""", "11", text, flags=re.I)
-    text = re.sub(r"""twelve""", "12", text, flags=re.I)
-    text = re.sub(r"""twenty""", "20", text, flags=re.I)
-    text = re.sub(r"""thirty""", "30", text, flags=re.I)
-    text = re.sub(r"""eighty""", "80", text, flags=re.I)
-    text = re.sub(r"""ninety""", "90", text, flags=re.I)
-    text = re.sub(r"""three""", "3", text, flags=re.I)
-    text = re.sub(r"""seven""", "7", text, flags=re.I)
-    text = re.sub(r"""eight""", "8", text, flags=re.I)
-    text = re.sub(r"""forty""", "40", text, flags=re.I)
-    text = re.sub(r"""fifty""", "50", text, flags=re.I)
-    text = re.sub(r"""sixty""", "60", text, flags=re.I)
-    text = re.sub(r"""zero""", "0", text, flags=re.I)
-    text = re.sub(r"""four""", "4", text, flags=re.I)
-    text = re.sub(r"""five""", "5", text, flags=re.I)
-    text = re.sub(r"""nine""", "9", text, flags=re.I)
-    text = re.sub(r"""one""", "1", text, flags=re.I)
-    text = re.sub(r"""two""", "2", text, flags=re.I)
-    text = re.sub(r"""six""", "6", text, flags=re.I)
-    text = re.sub(r"""ten""", "10", text, flags=re.I)
+    (r"""seventeen""", "17"),
+    (r"""thirteen""", "13"),
+    (r"""fourteen""", "14"),
+    (r"""eighteen""", "18"),
+    (r"""nineteen""", "19"),
+    (r"""fifteen""", "15"),
+    (r"""sixteen""", "16"),
+    (r"""seventy""", "70"),
+    (r"""eleven""", "11"),
+    (r"""twelve""", "12"),
+    (r"""twenty""", "20"),
+    (r"""thirty""", "30"),
+    (r"""eighty""", "80"),
+    (r"""ninety""", "90"),
+    (r"""three""", "3"),
+    (r"""seven""", "7"),
+    (r"""eight""", "8"),
+    (r"""forty""", "40"),
+    (r"""fifty""", "50"),
+    (r"""sixty""", "60"),
+    (r"""zero""", "0"),
+    (r"""four""", "4"),
+    (r"""five""", "5"),
+    (r"""nine""", "9"),
+    (r"""one""", "1"),
+    (r"""two""", "2"),
+    (r"""six""", "6"),
+    (r"""ten""", "10"),
+]
+
+LETTER_SUBSTITUTIONS = [
     # now do letter for digit substitutions
-    text = re.sub(r"""oh""", "0", text, flags=re.I)
-    text = re.sub(r"""o""", "0", text, flags=re.I)
-    text = re.sub(r"""i""", "1", text, flags=re.I)
-    text = re.sub(r"""l""", "1", text, flags=re.I)
+    (r"""oh""", "0"),
+    (r"""o""", "0"),
+    (r"""i""", "1"),
+    (r"""l""", "1"),
+]
+
+def compileSubstitutions(table):
+    '''compile (pattern, replacement) pairs into (literal, regexp, replacement),
+    literal being a fixed prefix every match of regexp must contain'''
+    return [(re.split(r"""\[""", pattern)[0], re.compile(pattern, flags=re.I), replacement)
+            for (pattern, replacement) in table]
+
+ENTITY_REGEXPS = compileSubstitutions(ENTITY_SUBSTITUTIONS)
+NUMERAL_REGEXPS = compileSubstitutions(NUMERAL_SUBSTITUTIONS)
+LETTER_REGEXPS = compileSubstitutions(LETTER_SUBSTITUTIONS)
+
+def cleanPhoneTextCascade(text):
+    '''reference normalizer: run every substitution over the whole text, in order'''
+    text = text.lower()
+    for (literal, regexp, replacement) in ENTITY_REGEXPS + NUMERAL_REGEXPS + LETTER_REGEXPS:
+        text = regexp.sub(replacement, text)
     return text
 
+# 17 October 2026
+# The numeral substitutions only ever match letters, digits, and the
+# connectors [\\w_ -] that follow a tens word.  So any other character,
+# and any connector not preceded by y, w, \ or _, cannot take part in a
+# match at any step of the cascade and splits the text into segments
+# that normalize independently.  cleanPhoneText scans the text once for
+# such segments and runs the cascade on each (distinct) segment only.
+
+def makeSegmentRegexp():
+    return re.compile(r"""(?:[a-z0-9]|(?<=[yw\\_])[\\_ -])+""", flags=re.I)
+
+SEGMENT_REGEXP = makeSegmentRegexp()
+NON_ASCII_REGEXP = re.compile(r"""[^\x00-\x7f]""")
+
+SEGMENT_CACHE = {}
+SEGMENT_CACHE_SIZE = 100000
+
+def cleanSegment(segment):
+    '''apply the numeral substitutions to one segment, memoized'''
+    try:
+        return SEGMENT_CACHE[segment]
+    except KeyError:
+        pass
+    cleaned = segment
+    # with re.I, a few non-ASCII letters match ASCII ones (e.g. long s),
+    # so the literal guard is only sound for ASCII segments
+    guarded = not NON_ASCII_REGEXP.search(segment)
+    for (literal, regexp, replacement) in NUMERAL_REGEXPS:
+        if not guarded or literal in cleaned:
+            cleaned = regexp.sub(replacement, cleaned)
+    if len(SEGMENT_CACHE) >= SEGMENT_CACHE_SIZE:
+        SEGMENT_CACHE.clear()
+    SEGMENT_CACHE[segment] = cleaned
+    return cleaned
+
+def stripPhoneText(text):
+    '''lowercase and remove numeric entities, the first steps of cleanPhoneText'''
+    text = text.lower()
+    if '&#' in text:
+        for (literal, regexp, replacement) in ENTITY_REGEXPS:
+            text = regexp.sub(replacement, text)
+    return text
+
+def normalizePhoneText(text):
+    '''the rest of cleanPhoneText, on text from stripPhoneText'''
+    text = SEGMENT_REGEXP.sub(lambda m: cleanSegment(m.group(0)), text)
+    for (literal, regexp, replacement) in LETTER_REGEXPS:
+        text = regexp.sub(replacement, text)
+    return text
+
+def cleanPhoneText(text):
+    '''normalize numeral words and lookalike letters to digits;
+    same result as cleanPhoneTextCascade in a single scan'''
+    return normalizePhoneText(stripPhoneText(text))
+
+# 17 October 2026
+# Prefilter.  A phone needs a [2-9] digit at positions 0 and 3, and
+# after normalization a [2-9] digit is either a [2-9] digit of the
+# stripped text, or comes from a numeral word (at most one per word, a
+# compound being two words; a unit made from a digit by the "twenty 1"
+# step is charged to that digit).  The misspelling step only turns 0
+# into o, 1 into i, and drops the u of fourty, so each numeral word
+# giving a [2-9] digit contains, in the stripped text, one of the stems
+# below.  Fewer than two positions where a [2-9] digit or a stem starts
+# therefore means no phone number.
+
+SOURCE_STEMS = [r"""[2-9]""",
+                r"""tw""",                # two, twelve, twenty
+                r"""th[i1]?r""",          # three, thirteen, thirty
+                r"""f[o0]u?r""",          # four, fourteen, forty
+                r"""f[i1](?:ve|ft)""",    # five, fifteen, fifty
+                r"""s[i1]x""",            # six, sixteen, sixty
+                r"""seven""",             # seven, seventeen, seventy
+                r"""e[i1]ght""",          # eight, eighteen, eighty
+                r"""n[i1]ne"""]           # nine, nineteen, ninety
+
+def makeSourceRegexp():
+    return re.compile(r"""(?=%s)""" % '|'.join(SOURCE_STEMS), flags=re.I)
+
+SOURCE_REGEXP = makeSourceRegexp()
+
+def mayContainPhone(text):
+    '''False only if text, from stripPhoneText, cannot contain a phone number'''
+    sources = SOURCE_REGEXP.finditer(text)
+    return next(sources, None) is not None and next(sources, None) is not None
+
 def makePhoneRegexp():
     return re.compile(r"""([[{(<]{0,3}[2-9][\W_]{0,3}\d[\W_]{0,3}\d[\W_]{0,6}[2-9][\W_]{0,3}\d[\W_]{0,3}\d[\W_]{0,6}\d[\W_]{0,3}\d[\W_]{0,3}\d[\W_]{0,3}\d)""")
 
@@ -277,7 +292,8 @@ PHONE_REGEXP = makePhoneRegexp()
 # 3 May 2012
 # new strategy: skip finditer, do the indexing ourselves
 
-def genPhones(text):
+def genPhonesRegexp(text):
+    '''reference scanner: re-search PHONE_REGEXP after every rejected candidate'''
     text = cleanPhoneText(text)
     regex = PHONE_REGEXP
     idx = 0
@@ -299,15 +315,242 @@ def genPhones(text):
             yield digits
             idx = end
         m = regex.search(text, idx)
-            
+
+# 17 October 2026
+# genPhonesRegexp is quadratic when a rejected candidate lies far past
+# idx: every 1 or 2 character step searches the whole gap again, only to
+# find the same match until idx passes its start.  Instead move idx in
+# one step to where that stepping would leave it, so that every search
+# starts past the previous match.
+
+NON_DIGIT_REGEXP = re.compile(r"""\D+""")
+
+def genPhones(text):
+    text = stripPhoneText(text)
+    if not mayContainPhone(text):
+        return
+    text = normalizePhoneText(text)
+    areaCodeIndex = areaCodes()[0]
+    regex = PHONE_REGEXP
+    idx = 0
+    m = regex.search(text, idx)
+    while m:
+        start = m.start(1)
+        end = m.end(1)
+        digits = NON_DIGIT_REGEXP.sub("", m.group(1))
+        prefix = text[start-1:start] if start>0 else None
+        if digits[0:2] == '82' and prefix == '*':
+            # this number overlaps with a *82 sequence
+            # step by 2 until past start
+            idx += 2 * ((start - idx) // 2 + 1)
+        elif digits[0:3] not in areaCodeIndex:
+            # probably a price, height, etc.
+            idx = start + 1
+        else:
+            # seems good
+            yield digits
+            idx = end
+        m = regex.search(text, idx)
+
+def extractorVersion():
+    '''identifies what extractPhoneNumbers returns: VERSION, REVISION and
+    the sha1 of the area code table'''
+    with open(AREA_CODE_TSV, 'rb') as f:
+        digest = hashlib.sha1(f.read()).hexdigest()
+    return '%s %s %s' % (VERSION, REVISION.strip(), digest)
+
+class PhoneCache(object):
+    '''memoizes extractPhoneNumbers by the sha1 of the text: an LRU of at
+    most size texts (none if size is 0), backed by an optional sqlite
+    database at path that can be shared across runs and processes.  The
+    database remembers the extractorVersion of its results and drops them
+    when that changes.  Counters are per process;
+    extractBatch adds those of its workers to the parent's.'''
+
+    COUNTERS = ('hits', 'dbHits', 'misses', 'evictions')
+
+    def __init__(self, size=100000, path=None):
+        self.size = size
+        self.path = path
+        self.entries = collections.OrderedDict()
+        self.db = None
+        self.pid = None
+        self.hits = 0
+        self.dbHits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def key(self, text):
+        if not isinstance(text, bytes):
+            text = text.encode('utf-8')
+        return hashlib.sha1(text).digest()
+
+    def connection(self):
+        # a forked worker needs its own connection
+        if self.pid != os.getpid():
+            self.db = sqlite3.connect(self.path, timeout=60, isolation_level=None)
+            self.db.execute("PRAGMA journal_mode=WAL")
+            self.db.execute("PRAGMA synchronous=NORMAL")
+            self.db.execute("CREATE TABLE IF NOT EXISTS phones (key BLOB PRIMARY KEY, phones TEXT)")
+            self.db.execute("CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value TEXT)")
+            self.checkVersion()
+            self.pid = os.getpid()
+        return self.db
+
+    def checkVersion(self):
+        version = extractorVersion()
+        # one process at a time, so that none drops what another has just added
+        self.db.execute("BEGIN IMMEDIATE")
+        try:
+            row = self.db.execute("SELECT value FROM meta WHERE name = 'version'").fetchone()
+            if row is None or row[0] != version:
+                self.db.execute("DELETE FROM phones")
+                self.db.execute("INSERT OR REPLACE INTO meta VALUES ('version', ?)", (version,))
+        except:
+            self.db.execute("ROLLBACK")
+            raise
+        self.db.execute("COMMIT")
+
+    def lookup(self, key):
+        try:
+            phones = self.entries.pop(key)
+        except KeyError:
+            pass
+        else:
+            self.hits += 1
+            self.entries[key] = phones
+            return phones
+        if self.path:
+            row = self.connection().execute("SELECT phones FROM phones WHERE key = ?",
+                                            (sqlite3.Binary(key),)).fetchone()
+            if row is not None:
+                self.dbHits += 1
+                phones = tuple(row[0].split(',')) if row[0] else ()
+                self.remember(key, phones)
+                return phones
+        self.misses += 1
+        return None
+
+    def remember(self, key, phones):
+        if not self.size:
+            # only the database then, say --cache-db without --cache-size
+            return
+        self.entries[key] = phones
+        if len(self.entries) > self.size:
+            self.entries.popitem(last=False)
+            self.evictions += 1
+
+    def extract(self, text):
+        key = self.key(text)
+        phones = self.lookup(key)
+        if phones is None:
+            phones = tuple(genPhones(text))
+            self.remember(key, phones)
+            if self.path:
+                self.connection().execute("INSERT OR IGNORE INTO phones VALUES (?, ?)",
+                                          (sqlite3.Binary(key), ','.join(phones)))
+        return list(phones)
+
+    def counts(self):
+        return collections.Counter(dict((name, getattr(self, name)) for name in self.COUNTERS))
+
+    def addCounts(self, counts):
+        for (name, n) in counts.items():
+            setattr(self, name, getattr(self, name) + n)
+
+    def stats(self):
+        stats = dict(self.counts())
+        stats['size'] = len(self.entries)
+        return stats
+
+# set by enablePhoneCache; worker processes forked afterwards inherit it
+PHONE_CACHE = None
+
+def enablePhoneCache(size=100000, path=None):
+    '''memoize extractPhoneNumbers from now on; returns the PhoneCache'''
+    global PHONE_CACHE
+    PHONE_CACHE = PhoneCache(size=size, path=path)
+    return PHONE_CACHE
+
 def extractPhoneNumbers(text):
+    if PHONE_CACHE is not None:
+        return PHONE_CACHE.extract(text)
     return [ph for ph in genPhones(text)]
 
+def extractPhoneNumbersList(texts):
+    '''(extractPhoneNumbers of each of texts, what that added to the
+    PhoneCache counters of this process or None)'''
+    before = PHONE_CACHE.counts() if PHONE_CACHE is not None else None
+    results = [extractPhoneNumbers(text) for text in texts]
+    if before is None:
+        return (results, None)
+    return (results, PHONE_CACHE.counts() - before)
+
+def extractBatch(texts, workers=None, chunksize=64, pending=None):
+    '''lazily yield extractPhoneNumbers(text) for each of texts, in order,
+    using a pool of workers processes (default: one per cpu; 1: no pool).
+    texts are sent to the pool chunksize at a time, with at most pending
+    chunks (default: 2 per worker) in flight.  The PhoneCache counters of
+    the workers are added to those of PHONE_CACHE.'''
+    if workers == 1:
+        for text in texts:
+            yield extractPhoneNumbers(text)
+        return
+    workers = workers or multiprocessing.cpu_count()
+    pending = pending or 2*workers
+    texts = iter(texts)
+    pool = multiprocessing.Pool(workers)
+    def collect(result):
+        (phonesList, counts) = result.get()
+        if counts and PHONE_CACHE is not None:
+            PHONE_CACHE.addCounts(counts)
+        return phonesList
+    try:
+        results = collections.deque()
+        for chunk in iter(lambda: list(itertools.islice(texts, chunksize)), []):
+            results.append(pool.apply_async(extractPhoneNumbersList, (chunk,)))
+            if len(results) >= pending:
+                for phones in collect(results.popleft()):
+                    yield phones
+        while results:
+            for phones in collect(results.popleft()):
+                yield phones
+    finally:
+        pool.terminate()
+        pool.join()
+
+def extractJsonLines(inf, outf, idField='id', textField='text', **kwargs):
+    '''read one json document per line from inf and write
+    {idField: id, "phones": [...]} for each to outf, in order;
+    kwargs go to extractBatch'''
+    ids = collections.deque()
+    def genTexts():
+        for line in inf:
+            if line.strip():
+                doc = json.loads(line)
+                ids.append(doc.get(idField))
+                yield doc.get(textField) or ''
+    for phones in extractBatch(genTexts(), **kwargs):
+        outf.write(json.dumps({idField: ids.popleft(), 'phones': phones}))
+        outf.write('\n')
+
 def main(argv=None):
     '''this is called if run from command line'''
     parser = argparse.ArgumentParser()
     parser.add_argument('inputFile', nargs='?', default=None, help='input text file')
     parser.add_argument('-v','--verbose', required=False, help='verbose', action='store_true')
+    parser.add_argument('-j','--jsonlines', required=False, action='store_true',
+                        help='input is one json document per line; write one json result per line')
+    parser.add_argument('--id-field', required=False, default='id', help='document id field for --jsonlines')
+    parser.add_argument('--text-field', required=False, default='text', help='document text field for --jsonlines')
+    parser.add_argument('-w','--workers', required=False, type=int, default=1,
+                        help='worker processes for --jsonlines, 0 for one per cpu')
+    parser.add_argument('--chunksize', required=False, type=int, default=64,
+                        help='documents per worker task for --jsonlines')
+    parser.add_argument('--cache-size', required=False, type=int, default=0,
+                        help='memoize results of up to this many texts (per process)')
+    parser.add_argument('--cache-db', required=False, default=None,
+                        help='sqlite file memoizing results across runs and processes')
     args=parser.parse_args()
 
     inputFile = args.inputFile
@@ -318,6 +561,16 @@ def main(argv=None):
     else:
         inf = sys.stdin
 
+    if args.cache_size or args.cache_db:
+        enablePhoneCache(size=args.cache_size, path=args.cache_db)
+
+    if args.jsonlines:
+        extractJsonLines(inf, sys.stdout, idField=args.id_field, textField=args.text_field,
+                         workers=args.workers, chunksize=args.chunksize)
+        if verbose and PHONE_CACHE is not None:
+            print >> sys.stderr, "cache %r" % PHONE_CACHE.stats()
+        return 0
+
     print extractPhoneNumbers(inf.read())
 
 # call main() if this is run as standalone
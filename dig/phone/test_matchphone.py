@@ -0,0 +1,155 @@
+# -*- coding: utf-8 -*-
+
+'''
+cleanPhoneText and genPhones against their reference implementations,
+cleanPhoneTextCascade and genPhonesRegexp, on data/test.txt and on random
+texts built from numeral words, misspellings, digits and separators
+'''
+
+import io
+import json
+import os
+import random
+import re
+
+import pytest
+
+from dig.phone import matchphone
+
+SEED = 20141017
+RANDOM_TEXTS = 5000
+
+CHECK_FRAGMENTS = (matchphone.UNITS + matchphone.TENS +
+                   [replacement for (pattern, replacement) in matchphone.NUMERAL_SUBSTITUTIONS] +
+                   [pattern for (pattern, replacement) in matchphone.NUMERAL_SUBSTITUTIONS[:23]] +
+                   ['ten', 'eleven', 'twelve', 'teen', 'hundred', 'thousand', 'oh', 'o', 'i', 'l',
+                    'w', 'y', 'ty', '&#', '&#12;', ';', '\\', '_', '-', ' ', '.', '*', '(', ')', '/',
+                    '[', '{', '<', '*82', '828', '911', '212 555', '0', '1', '2', '3', '4', '5',
+                    '6', '7', '8', '9', 'a', 'e', 'n', 't', 'x', 'call me'])
+
+# few [2-9] digits, so that mayContainPhone has something to reject
+SPARSE_CHECK_FRAGMENTS = [f for f in CHECK_FRAGMENTS if not re.search(r"""[2-9]""", f)] + ['7']
+
+def randomPhoneText(rng, fragments=CHECK_FRAGMENTS, maxFragments=24):
+    '''random text built from numeral words, misspellings, digits and separators'''
+    fragments = [rng.choice(fragments) for i in range(rng.randint(1, maxFragments))]
+    return ''.join(f.upper() if rng.random() < 0.1 else f for f in fragments)
+
+def readTestTexts():
+    with open(os.path.join(matchphone.DATA_DIR, 'test.txt')) as f:
+        return f.read().splitlines()
+
+def randomTexts(fragments):
+    rng = random.Random(SEED)
+    return [randomPhoneText(rng, fragments) for i in range(RANDOM_TEXTS)]
+
+# small enough for the quadratic genPhonesRegexp
+ADVERSARIAL_SIZE = 2000
+
+def adversarialTexts(size=ADVERSARIAL_SIZE):
+    '''long texts of rejected candidates, *82 sequences and back to back phones'''
+    return ['x' * size + '911 555 1212',
+            'x' * size + '(((212) 555 1212',
+            ('9' * 10 + ' ') * (size // 11),
+            '9-1-1-' * (size // 6),
+            '*82' * (size // 3),
+            '*82' * (size // 3) + '2125551212',
+            '2125551212' * (size // 10),
+            '(212)-555-1212.' * (size // 15)]
+
+CORPORA = {
+    'adversarial': adversarialTexts,
+    'test.txt': readTestTexts,
+    'random': lambda: randomTexts(CHECK_FRAGMENTS),
+    'sparse': lambda: randomTexts(SPARSE_CHECK_FRAGMENTS),
+}
+
+@pytest.fixture(params=sorted(CORPORA))
+def texts(request):
+    return CORPORA[request.param]()
+
+def test_clean_phone_text(texts):
+    for text in texts:
+        assert matchphone.cleanPhoneText(text) == matchphone.cleanPhoneTextCascade(text), text
+
+def test_gen_phones(texts):
+    for text in texts:
+        assert list(matchphone.genPhones(text)) == list(matchphone.genPhonesRegexp(text)), text
+
+def test_prefilter_rejects_only_texts_without_phones():
+    '''mayContainPhone(stripPhoneText(text)) may only be False if the
+    reference scanner finds no phone number in text'''
+    rejected = 0
+    for text in randomTexts(SPARSE_CHECK_FRAGMENTS):
+        if not matchphone.mayContainPhone(matchphone.stripPhoneText(text)):
+            rejected += 1
+            assert not list(matchphone.genPhonesRegexp(text)), text
+    # the sparse corpus is meant to exercise the rejections
+    assert rejected > RANDOM_TEXTS // 50
+
+PHONE_TEXTS = ['call 212 555 1212', 'call 312 555 1212', 'call 412 555 1212']
+
+def test_phone_cache_evicts_least_recently_used():
+    (a, b, c) = PHONE_TEXTS
+    cache = matchphone.PhoneCache(size=2)
+    for text in [a, b, a, c, b]:
+        assert cache.extract(text) == list(matchphone.genPhones(text))
+    # a was used after b, so c evicted b; b then evicted a
+    assert list(cache.entries) == [cache.key(c), cache.key(b)]
+    assert cache.stats() == {'hits': 1, 'dbHits': 0, 'misses': 4, 'evictions': 2, 'size': 2}
+
+def test_phone_cache_counts_add_up():
+    cache = matchphone.PhoneCache(size=2)
+    for text in PHONE_TEXTS[:2] * 2:
+        cache.extract(text)
+    cache.addCounts(cache.counts())
+    assert cache.stats() == {'hits': 4, 'dbHits': 0, 'misses': 4, 'evictions': 0, 'size': 2}
+
+def test_phone_cache_of_size_0_keeps_only_the_database(tmpdir):
+    path = str(tmpdir.join('cache.db'))
+    cache = matchphone.PhoneCache(size=0, path=path)
+    for text in PHONE_TEXTS * 2:
+        assert cache.extract(text) == list(matchphone.genPhones(text))
+    assert not cache.entries
+    assert cache.stats() == {'hits': 0, 'dbHits': 3, 'misses': 3, 'evictions': 0, 'size': 0}
+
+def test_phone_cache_drops_results_of_another_version(tmpdir, monkeypatch):
+    path = str(tmpdir.join('cache.db'))
+    text = 'call 212 555 1212'
+    cache = matchphone.PhoneCache(size=0, path=path)
+    assert cache.extract(text) == ['2125551212']
+    cache.connection().execute("UPDATE phones SET phones = 'stale'")
+    assert matchphone.PhoneCache(size=0, path=path).extract(text) == ['stale']
+    monkeypatch.setattr(matchphone, 'VERSION', matchphone.VERSION + '.1')
+    cache = matchphone.PhoneCache(size=0, path=path)
+    assert cache.extract(text) == ['2125551212']
+    assert cache.misses == 1
+
+def batchTexts(n=50):
+    '''texts with distinct phones, some with none, so that any reordering shows'''
+    return ['no phone here' if i % 7 == 0 else 'call 212 555 %04d or 312 %03d 1212' % (i, i + 200)
+            for i in range(n)]
+
+def test_extract_batch_keeps_order_across_workers(monkeypatch):
+    monkeypatch.setattr(matchphone, 'PHONE_CACHE', matchphone.PhoneCache(size=100))
+    texts = batchTexts()
+    expected = [list(matchphone.genPhones(text)) for text in texts]
+    assert list(matchphone.extractBatch(texts, workers=2, chunksize=3, pending=2)) == expected
+    # each worker has its own LRU, but every text is counted once
+    counts = matchphone.PHONE_CACHE.counts()
+    assert counts['hits'] + counts['misses'] == len(texts)
+    assert counts['misses'] >= len(set(texts))
+
+def test_extract_json_lines_keeps_ids_across_workers(monkeypatch):
+    monkeypatch.setattr(matchphone, 'PHONE_CACHE', None)
+    texts = batchTexts()
+    lines = [json.dumps({'doc': 'd%d' % i, 'body': text}) + '\n' for (i, text) in enumerate(texts)]
+    # blank lines are skipped, a document without text has no phones
+    lines[10:10] = ['\n', json.dumps({'doc': 'empty'}) + '\n']
+    outf = io.BytesIO()
+    matchphone.extractJsonLines(lines, outf, idField='doc', textField='body',
+                                workers=2, chunksize=3, pending=2)
+    expected = [{'doc': 'd%d' % i, 'phones': list(matchphone.genPhones(text))}
+                for (i, text) in enumerate(texts)]
+    expected[10:10] = [{'doc': 'empty', 'phones': []}]
+    assert [json.loads(line) for line in outf.getvalue().splitlines()] == expected
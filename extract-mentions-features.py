@@ -12,43 +12,426 @@ line option.
 from __future__ import absolute_import, division, print_function
 
 import argparse
+from array import array
+import bisect
 from collections import defaultdict
+import errno
+import glob
+import gzip
+from itertools import groupby, izip
+import hashlib
 import json
+import mmap
 import os
 import io
+import multiprocessing
+import operator
+import Queue
+import random
+import re
+import shutil
+import sys
+import threading
+import time
+import zlib
 
+import cbor
 from dossier.fc import \
     FeatureCollection, FeatureCollectionCborChunk, StringCounter
 
 HTML_TABLE = u'<table><tr><th>Attr</th><th>Values</th></tr>{rows}</table>'
 HTML_TR = u'<tr><td>{attr}</td><td>{vals}</td></tr>'
+WHITESPACE = re.compile(r'\s*')
 
-def group_mentions_as_features(jsonfile):
+# MinHash signatures take the minimum of MINHASH_PERMUTATIONS universal
+# hashes (a * x + b) % MINHASH_PRIME of an ad's tokens; the prime keeps
+# the products in machine ints and the parameters are fixed so that
+# signatures agree across runs
+MINHASH_PERMUTATIONS = 128
+MINHASH_PRIME = (1 << 31) - 1
+
+def minhash_params(seed, permutations=MINHASH_PERMUTATIONS):
+    '''
+    The (a, b) of each universal hash of the MinHash signatures, the
+    same for the same seed
+    '''
+    rng = random.Random(seed)
+    params = []
+    for _ in range(permutations):
+        a = rng.randrange(1, MINHASH_PRIME)
+        b = rng.randrange(0, MINHASH_PRIME)
+        params.append((a, b))
+    return params
+
+MINHASH_PARAMS = minhash_params(20141017)
+
+class PipelineStats(object):
+    '''
+    Timings and counts of a run, collected with --stats.
+
+    Stage seconds are cumulative over the run: 'parse' (reading the
+    json), 'read' (parse plus grouping mentions by ad), 'build' (the
+    FC's adid, attrvals and NAME), 'trans_<name>' for each transform and
+    'serialize' (chunk.add). With --write-queue, 'serialize' is only
+    queueing the FC and 'write' is chunk.add on the background thread.
+    Per ad latency (build to serialize) and the number of distinct
+    values per ad of each feature are kept as histograms, so memory does
+    not grow with the number of ads. Collecting them costs a few
+    microseconds per ad, about 5% of a run with --transforms features.
+    '''
+    def __init__(self):
+        self.seconds = defaultdict(float)
+        self.ads = 0
+        self.mentions = 0
+        self.features = 0
+        # ads skipped by --incremental as unchanged since the last run
+        self.unchanged = 0
+        # microseconds, rounded up to a power of 2 |--> ads
+        self.ad_latency = defaultdict(int)
+        # (featname, number of distinct values) |--> ads
+        self.cardinality = defaultdict(int)
+
+    def lap(self, stage, start):
+        '''
+        Adds the time since start to stage and returns the current time
+        '''
+        now = time.time()
+        self.seconds[stage] += now - start
+        return now
+
+    def timed(self, stage, iterable):
+        '''
+        Yields from iterable, adding the time spent getting each item to
+        stage
+        '''
+        it = iter(iterable)
+        while True:
+            start = time.time()
+            try:
+                item = next(it)
+            except StopIteration:
+                self.lap(stage, start)
+                return
+            self.lap(stage, start)
+            yield item
+
+    def count_ad(self, attrvals, fc, seconds):
+        self.ads += 1
+        self.features += len(fc)
+        cardinality = self.cardinality
+        mentions = 0
+        for attr, vals in attrvals.iteritems():
+            n = len(vals)
+            mentions += n
+            # most attributes of an ad have a single value
+            cardinality[attr, len(set(vals)) if n > 1 else n] += 1
+        self.mentions += mentions
+        micros = max(1, -int(-seconds * 1e6))
+        self.ad_latency[1 << (micros - 1).bit_length()] += 1
+
+    def merge(self, other):
+        for stage, seconds in other.seconds.items():
+            self.seconds[stage] += seconds
+        self.ads += other.ads
+        self.mentions += other.mentions
+        self.features += other.features
+        self.unchanged += other.unchanged
+        for bucket, ads in other.ad_latency.items():
+            self.ad_latency[bucket] += ads
+        for key, ads in other.cardinality.items():
+            self.cardinality[key] += ads
+
+    def latency_percentile(self, p):
+        '''
+        Upper bound, in microseconds, of the per ad latency percentile p
+        '''
+        seen = 0
+        for bucket in sorted(self.ad_latency):
+            seen += self.ad_latency[bucket]
+            if seen * 100 >= p * self.ads:
+                return bucket
+        return None
+
+    def cardinality_histograms(self):
+        '''
+        featname |--> {number of distinct values: ads}
+        '''
+        histograms = {}
+        for (attr, distinct), ads in self.cardinality.items():
+            histograms.setdefault(attr, {})[distinct] = ads
+        return histograms
+
+    def report(self):
+        seconds = dict(self.seconds)
+        if 'read' in seconds:
+            seconds['group'] = seconds['read'] - seconds.get('parse', 0)
+        return {
+            'seconds': seconds,
+            'ads': self.ads,
+            'mentions': self.mentions,
+            'features': self.features,
+            'unchanged': self.unchanged,
+            'ad_latency_us': {
+                'p50': self.latency_percentile(50),
+                'p99': self.latency_percentile(99),
+                'histogram': dict(self.ad_latency),
+            },
+            'cardinality': self.cardinality_histograms(),
+        }
+
+    def summary(self):
+        report = self.report()
+        lines = ['%d ads, %d mentions, %d features, %d unchanged ads'
+                 % (self.ads, self.mentions, self.features, self.unchanged)]
+        for stage, seconds in sorted(report['seconds'].items()):
+            per_ad = seconds / self.ads * 1e6 if self.ads else 0
+            lines.append('%-20s %10.3fs %10.1fus/ad'
+                         % (stage, seconds, per_ad))
+        lines.append('ad latency p50 <= %sus, p99 <= %sus'
+                     % tuple('-' if report['ad_latency_us'][p] is None
+                             else report['ad_latency_us'][p]
+                             for p in ['p50', 'p99']))
+        for attr, hist in sorted(report['cardinality'].items()):
+            lines.append('%-20s %s' % (attr, ' '.join(
+                '%d:%d' % (distinct, ads)
+                for distinct, ads in sorted(hist.items()))))
+        return '\n'.join(lines)
+
+def mention_feature_uris(item):
+    '''
+    Yields the memex:feature uri of each mention of a karma item
+
+    :type item: dict
+    '''
+    mentions = item.get('schema:mentions', [])
+    if not isinstance(mentions, list):
+        # This means mentions is a single object
+        mentions = [mentions]
+    for mention in mentions:
+        yield mention['memex:feature']
+
+def split_feature_uri(feature):
+    '''
+    Returns the (featname, featval) of a memex:feature uri
+    '''
+    feature_splits = feature.rsplit('/', 2)
+    return feature_splits[1], feature_splits[2]
+
+def mention_features(item):
+    '''
+    Yields (featname, featval) for each mention of a karma item
+
+    :type item: dict
+    '''
+    for feature in mention_feature_uris(item):
+        yield split_feature_uri(feature)
+
+class AdMentions(object):
+    '''
+    The mentions of an ad in a MentionStore: the ids of their features,
+    in the order mentioned
+    '''
+    __slots__ = ('features',)
+
+    def __init__(self):
+        self.features = array('I')
+
+class MentionStore(object):
+    '''
+    The mentions of many ads, grouped by adid, in a fraction of the
+    memory of adid |--> featname |--> [featval].
+
+    Each distinct memex:feature uri is split once and interned as a
+    feature id, a pair of interned featname and featval ids, so every
+    mention of an ad is 4 bytes in its AdMentions. The attrvals of an
+    ad are built when it is looked up.
+    '''
+    def __init__(self):
+        # adid |--> AdMentions
+        self.ads = {}
+        # memex:feature uri |--> feature id
+        self.feature_ids = {}
+        # feature id |--> featname id, featval id
+        self.feature_names = array('I')
+        self.feature_values = array('I')
+        # featname or featval id |--> string, and back
+        self.strings = []
+        self.string_ids = {}
+
+    def intern(self, string):
+        string_id = self.string_ids.get(string)
+        if string_id is None:
+            string_id = self.string_ids[string] = len(self.strings)
+            self.strings.append(string)
+        return string_id
+
+    def feature_id(self, feature):
+        '''
+        Returns the id of a memex:feature uri, interning it if new
+        '''
+        feature_id = self.feature_ids.get(feature)
+        if feature_id is None:
+            featname, featval = split_feature_uri(feature)
+            feature_id = self.feature_ids[feature] = len(self.feature_names)
+            self.feature_names.append(self.intern(featname))
+            self.feature_values.append(self.intern(featval))
+        return feature_id
+
+    def add(self, adid, item):
+        '''
+        Adds the mentions of a karma item to the ad adid
+        '''
+        for feature in mention_feature_uris(item):
+            ad = self.ads.get(adid)
+            if ad is None:
+                ad = self.ads[adid] = AdMentions()
+            ad.features.append(self.feature_id(feature))
+
+    def attrvals(self, ad):
+        '''
+        :type ad: AdMentions
+        :rtype: featname |--> [featval]
+        '''
+        attrvals = {}
+        for feature_id in ad.features:
+            featname = self.strings[self.feature_names[feature_id]]
+            featval = self.strings[self.feature_values[feature_id]]
+            attrvals.setdefault(featname, []).append(featval)
+        return attrvals
+
+    def __len__(self):
+        return len(self.ads)
+
+    def __contains__(self, adid):
+        return adid in self.ads
+
+    def __getitem__(self, adid):
+        return self.attrvals(self.ads[adid])
+
+    def __iter__(self):
+        return iter(self.ads)
+
+    def iteritems(self):
+        for adid, ad in self.ads.iteritems():
+            yield adid, self.attrvals(ad)
+
+def read_more(jsonfile, buf, idx, chunk_size):
+    '''
+    Drops the consumed buf[:idx] and appends the next chunk of jsonfile.
+    Returns the new (buf, idx, eof).
+    '''
+    more = jsonfile.read(chunk_size)
+    return buf[idx:] + more, 0, not more
+
+def iter_karma_items(jsonfile, chunk_size=1 << 16):
+    '''
+    Yields the items of a karma json file one at a time, reading it
+    in chunks of chunk_size.
+
+    The file is either a single json array of items (as karma writes
+    it) or a sequence of items separated by whitespace, which includes
+    json-lines. Like json.load, raises ValueError for malformed input,
+    including a trailing comma or anything after the array.
+    '''
+    decoder = json.JSONDecoder()
+    buf, idx, eof = '', 0, False
+    in_array = None
+    # in an array, whether , or ] comes next, after an item
+    separator = False
+    # in an array, whether an item must come next, after a ,
+    item_expected = False
+    closed = False
+    # doubled while an item does not fit, so that a large item is not
+    # parsed again from its start for every chunk
+    read_size = chunk_size
+    while True:
+        idx = WHITESPACE.match(buf, idx).end()
+        if idx == len(buf) and not eof:
+            buf, idx, eof = read_more(jsonfile, buf, idx, chunk_size)
+            continue
+        if in_array is None:
+            in_array = buf.startswith('[', idx)
+            if in_array:
+                idx += 1
+            continue
+        if closed:
+            if idx < len(buf):
+                raise ValueError('extra data after the json array: %r'
+                                 % buf[idx:idx + 20])
+            return
+        if idx == len(buf):
+            if in_array:
+                raise ValueError('unterminated json array')
+            return
+        if in_array and buf[idx] == ']':
+            if item_expected:
+                raise ValueError('trailing , in json array')
+            idx += 1
+            closed = True
+            continue
+        if separator:
+            if buf[idx] != ',':
+                raise ValueError('expected , or ] but got %r' % buf[idx])
+            idx += 1
+            separator = False
+            item_expected = True
+            continue
+        try:
+            item, end = decoder.raw_decode(buf, idx)
+        except ValueError:
+            if eof:
+                raise
+            # the item continues in the next chunk
+            buf, idx, eof = read_more(jsonfile, buf, idx, read_size)
+            read_size *= 2
+            continue
+        if end == len(buf) and not eof:
+            # a number may continue in the next chunk
+            buf, idx, eof = read_more(jsonfile, buf, idx, read_size)
+            read_size *= 2
+            continue
+        idx = end
+        read_size = chunk_size
+        separator = in_array
+        item_expected = False
+        yield item
+
+def gen_mentions_as_features(jsonfile, stats=None):
+    '''
+    Yields (obj_id, attrvals) for each item of the karma json file,
+    reading it incrementally; see iter_karma_items.
+
+    Consecutive items with the same @id are merged into one. Items of an
+    ad that are not consecutive yield that ad again, so input that may
+    repeat an @id should be sorted by @id first.
+
+    :type stats: PipelineStats
+    '''
+    items = iter_karma_items(jsonfile)
+    if stats is not None:
+        items = stats.timed('parse', items)
+    for obj_id, obj_items in groupby(items, lambda item: item['@id']):
+        attrvals = {}
+        for item in obj_items:
+            for featname, featval in mention_features(item):
+                attrvals.setdefault(featname, []).append(featval)
+        if attrvals:
+            yield obj_id, attrvals
+
+def group_mentions_as_features(jsonfile, stats=None):
     '''
     Groups features from the json file coming from karma [which isn't really json]
+
+    :type stats: PipelineStats
+    :rtype: MentionStore
     '''
-    grouped = defaultdict(dict)
-
-    json_array = json.load(jsonfile, "utf-8")
-    for item in json_array:
-        obj_id = item['@id']
-        if 'schema:mentions' in item:
-            mentions = item['schema:mentions']
-            if isinstance(mentions, list) and len(mentions) > 1:
-                for mention in item['schema:mentions']:
-                    feature = mention['memex:feature']
-                    feature_splits = feature.rsplit('/', 2)
-                    featname = feature_splits[1]
-                    featval = feature_splits[2]
-                    grouped[obj_id].setdefault(featname, []).append(featval)
-            else:
-                # This means mentions is a single object
-                mention = mentions
-                feature = mention['memex:feature']
-                feature_splits = feature.rsplit('/', 2)
-                featname = feature_splits[1]
-                featval = feature_splits[2]
-                grouped[obj_id].setdefault(featname, []).append(featval)
+    grouped = MentionStore()
+
+    items = iter_karma_items(jsonfile)
+    if stats is not None:
+        items = stats.timed('parse', items)
+    for item in items:
+        grouped.add(item['@id'], item)
     return grouped
 
 def trans_display(fc, adid, attrvals):
@@ -92,32 +475,1624 @@ def trans_features(fc, adid, attrvals):
                 feature = attr + '-' + val
                 fc['bosb'][feature] += 1
 
+def minhash_signature(tokens):
+    '''
+    The MinHash signature of a set of tokens: for a pair of sets, the
+    fraction of equal positions estimates their Jaccard similarity
+
+    :type tokens: set of unicode
+    :rtype: array('I') of MINHASH_PERMUTATIONS
+    '''
+    hashes = [zlib.crc32(token.encode('utf-8')) % MINHASH_PRIME
+              for token in tokens]
+    return array('I', [min([(a * h + b) % MINHASH_PRIME for h in hashes])
+                       for a, b in MINHASH_PARAMS])
+
+def fc_tokens(fc):
+    '''
+    The set of ``featname<TAB>value`` of the StringCounter features of
+    fc but NAME: bosb and the attributes, after trans_features
+    '''
+    tokens = set()
+    for feature, counter in fc.iteritems():
+        if feature != 'NAME' and isinstance(counter, StringCounter):
+            tokens.update(feature + u'\t' + value for value in counter)
+    return tokens
+
+def trans_minhash(fc, adid, attrvals):
+    '''
+    MinHash signature of the features of the ad, as hex, for the LSH
+    index of near duplicate ads; run it after features. Ads without
+    features get none.
+
+    :type fc: FeatureCollection
+    :type adid: str
+    :type attrvals: featname |--> [featval]
+    '''
+    tokens = fc_tokens(fc)
+    if tokens:
+        fc['minhash'] = u''.join(u'%08x' % value
+                                 for value in minhash_signature(tokens))
+
+def make_fc(adid, attrvals, transforms, stats=None):
+    '''
+    Builds the FeatureCollection of an ad and runs the transforms on it
+
+    :type adid: str
+    :type attrvals: featname |--> [featval]
+    :type transforms: [str]
+    :type stats: PipelineStats
+    '''
+    start = time.time()
+    fc = FeatureCollection()
+    fc['adid'] = adid
+    fc['attrvals'] = json.dumps(attrvals).decode('utf-8')
+    fc['NAME'] = StringCounter({adid: 1})
+    if stats is not None:
+        start = stats.lap('build', start)
+    for trans in transforms:
+        globals()['trans_%s' % trans](fc, adid, attrvals)
+        if stats is not None:
+            start = stats.lap('trans_%s' % trans, start)
+    return fc
+
+def write_fc(chunk, adid, attrvals, transforms, stats=None):
+    '''
+    Builds the FeatureCollection of an ad and adds it to chunk
+
+    :type stats: PipelineStats
+    '''
+    if stats is None:
+        chunk.add(make_fc(adid, attrvals, transforms))
+        return
+    start = time.time()
+    fc = make_fc(adid, attrvals, transforms, stats)
+    added = time.time()
+    chunk.add(fc)
+    end = stats.lap('serialize', added)
+    stats.count_ad(attrvals, fc, end - start)
+
+def shard_of(adid, shards):
+    '''
+    Stable shard number of an ad, the same in every run and process
+    '''
+    return (zlib.crc32(adid.encode('utf-8')) & 0xffffffff) % shards
+
+def shard_path(path, shard, shards):
+    return '%s-%05d-of-%05d' % (path, shard, shards)
+
+def write_shard(queue, path, transforms, stats_queue=None, index=False):
+    '''
+    Worker: writes the ads it receives on queue to the chunk at path,
+    in the order received, until it gets None. With stats_queue, puts
+    its PipelineStats there when done. With index, the chunk is an
+    IndexedChunk.
+    '''
+    stats = PipelineStats() if stats_queue is not None else None
+    if index:
+        chunk = IndexedChunk(path, transforms, mode='wb')
+    else:
+        chunk = FeatureCollectionCborChunk(path=path, mode='wb')
+    for adid, attrvals in iter(queue.get, None):
+        write_fc(chunk, adid, attrvals, transforms, stats)
+    chunk.close()
+    if stats_queue is not None:
+        stats_queue.put(stats)
+
+def check_writable(path):
+    '''
+    Raises IOError if a chunk cannot be created at path
+    '''
+    if os.path.exists(path):
+        raise IOError(errno.EEXIST, 'would overwrite existing %s' % path)
+    dirname = os.path.dirname(path) or '.'
+    if os.path.isdir(dirname) and not os.access(dirname, os.W_OK):
+        raise IOError(errno.EACCES, 'cannot write to %s' % dirname)
+
+def check_workers(procs, paths):
+    '''
+    Raises RuntimeError, after terminating the others, if a worker
+    writing one of paths has failed
+    '''
+    failed = [shard for proc, shard in zip(procs, paths)
+              if proc.exitcode not in (None, 0)]
+    if failed:
+        for proc in procs:
+            if proc.is_alive():
+                proc.terminate()
+        raise RuntimeError('failed to write %s' % ', '.join(failed))
+
+def discard_queue(queue, timeout=0.1):
+    '''
+    Reads and drops what is left on the queue of a dead worker, so that
+    its feeder thread does not keep this process from exiting
+    '''
+    queue.cancel_join_thread()
+    try:
+        while True:
+            queue.get(timeout=timeout)
+    except Queue.Empty:
+        pass
+
+def put_checked(queue, item, procs, paths, timeout=1):
+    '''
+    Puts item on a worker's queue, checking that the workers are alive
+    while the queue is full
+    '''
+    while True:
+        try:
+            queue.put(item, timeout=timeout)
+            return
+        except Queue.Full:
+            check_workers(procs, paths)
+
+def get_checked(queue, procs, paths, timeout=1):
+    '''
+    Gets an item off the workers' queue, checking that the workers are
+    alive while it is empty
+    '''
+    while True:
+        try:
+            return queue.get(timeout=timeout)
+        except Queue.Empty:
+            check_workers(procs, paths)
+
+def write_sharded(grouped, path, transforms, workers, queue_size=1000,
+                  stats=None, index=False):
+    '''
+    Partitions the ads by shard_of their adid over a pool of worker
+    processes, each running the transforms and writing its own chunk,
+    indexed if index. Returns the shard chunk paths. Raises
+    RuntimeError as soon as a worker fails.
+
+    :type grouped: iterable of (adid, attrvals)
+    :type stats: PipelineStats, which gets the workers' stats merged in
+    '''
+    paths = [shard_path(path, i, workers) for i in range(workers)]
+    for shard in paths:
+        check_writable(shard)
+    queues = [multiprocessing.Queue(queue_size) for _ in paths]
+    stats_queue = multiprocessing.Queue() if stats is not None else None
+    procs = [multiprocessing.Process(target=write_shard,
+                                     args=(queue, shard, transforms,
+                                           stats_queue, index))
+             for queue, shard in zip(queues, paths)]
+    for proc in procs:
+        proc.start()
+    try:
+        for adid, attrvals in grouped:
+            put_checked(queues[shard_of(adid, workers)], (adid, attrvals),
+                        procs, paths)
+        for queue in queues:
+            put_checked(queue, None, procs, paths)
+        if stats is not None:
+            for _ in procs:
+                stats.merge(get_checked(stats_queue, procs, paths))
+        for proc in procs:
+            proc.join()
+        check_workers(procs, paths)
+    except BaseException:
+        for proc in procs:
+            if proc.is_alive():
+                proc.terminate()
+        for queue in queues:
+            discard_queue(queue)
+        raise
+    return paths
+
+def merge_chunks(paths, path):
+    '''
+    Concatenates the FC chunks at paths, in order, into one chunk at path,
+    copying the FCs without decoding them
+    '''
+    if os.path.exists(path):
+        raise IOError(errno.EEXIST, 'would overwrite existing %s' % path)
+    with open(path, 'wb') as fout:
+        for shard in paths:
+            with open(shard, 'rb') as fin:
+                shutil.copyfileobj(fin, fout)
+
+def rolled_path(path, number, compress=False):
+    return '%s-%05d%s' % (path, number, '.gz' if compress else '')
+
+class RollingChunk(object):
+    '''
+    Writes FCs to the numbered chunks rolled_path(path, 0), 1, ...,
+    gzipped if compress, starting the next one when the current one has
+    max_fcs FCs or max_bytes bytes on disk. Each chunk is written to its
+    path + '.part' and renamed once complete and synced, so an
+    interrupted run leaves its complete chunks and at most one .part.
+
+    Has the add, flush and close of a chunk, so write_fc can write to it.
+    paths has the complete chunks.
+    '''
+    def __init__(self, path, max_bytes=None, max_fcs=None, compress=False):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.max_fcs = max_fcs
+        self.compress = compress
+        self.paths = []
+        self.chunk = None
+
+    def start(self):
+        self.current = rolled_path(self.path, len(self.paths), self.compress)
+        if os.path.exists(self.current):
+            raise IOError(errno.EEXIST,
+                          'would overwrite existing %s' % self.current)
+        self.fh = open(self.current + '.part', 'wb')
+        self.gz = None
+        if self.compress:
+            self.gz = gzip.GzipFile(fileobj=self.fh, mode='wb')
+        self.chunk = FeatureCollectionCborChunk(file_obj=self.gz or self.fh,
+                                                mode='wb')
+        self.fcs = 0
+
+    def roll(self):
+        '''
+        Completes the current chunk
+        '''
+        if self.gz is not None:
+            # writes the gzip trailer, leaving fh open
+            self.gz.close()
+        self.fh.flush()
+        os.fsync(self.fh.fileno())
+        self.fh.close()
+        os.rename(self.current + '.part', self.current)
+        self.paths.append(self.current)
+        self.chunk = None
+
+    def add(self, fc):
+        if self.chunk is None:
+            self.start()
+        self.chunk.add(fc)
+        self.fcs += 1
+        if (self.max_fcs and self.fcs >= self.max_fcs) or \
+                (self.max_bytes and self.fh.tell() >= self.max_bytes):
+            self.roll()
+
+    def flush(self):
+        if self.chunk is not None:
+            self.chunk.flush()
+
+    def close(self):
+        if self.chunk is not None:
+            self.roll()
+
+class BackgroundChunk(object):
+    '''
+    Adds FCs to chunk on a background thread, through a queue of at most
+    queue_size FCs, so that reading and transforming the next ads
+    overlaps with serializing, compressing and writing FCs. An error of
+    the thread is raised by the next add or by close.
+
+    Has the add, flush and close of a chunk, so write_fc can write to it.
+
+    :type stats: PipelineStats, which gets the thread's 'write' seconds
+                 on close
+    '''
+    def __init__(self, chunk, queue_size, stats=None):
+        self.chunk = chunk
+        self.queue = Queue.Queue(queue_size)
+        self.error = None
+        self.stats = stats
+        self.seconds = 0.0
+        self.thread = threading.Thread(target=self.write)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def write(self):
+        for fc in iter(self.queue.get, None):
+            # after an error, only drain the queue so add never blocks
+            if self.error is None:
+                start = time.time()
+                try:
+                    self.chunk.add(fc)
+                except Exception as e:
+                    self.error = e
+                self.seconds += time.time() - start
+            self.queue.task_done()
+        self.queue.task_done()
+
+    def check(self):
+        if self.error is not None:
+            raise self.error
+
+    def add(self, fc):
+        self.check()
+        self.queue.put(fc)
+
+    def flush(self):
+        '''
+        Waits for the queued FCs to be added and flushes chunk
+        '''
+        self.queue.join()
+        self.check()
+        self.chunk.flush()
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+        self.check()
+        self.chunk.close()
+        if self.stats is not None:
+            self.stats.seconds['write'] += self.seconds
+
+def index_path(path):
+    return path + '.index'
+
+def fc_digest(attrvals_json, transforms):
+    '''
+    Content hash of the FC of an ad: its attrvals, as json in
+    fc['attrvals'], and the transforms run on it
+
+    :type attrvals_json: unicode
+    :type transforms: [str]
+    '''
+    content = u'\t'.join(transforms) + u'\n' + attrvals_json
+    return hashlib.sha1(content.encode('utf-8')).hexdigest()
+
+def index_line(adid, digest, offset, length):
+    return u'%s\t%s\t%d\t%d\n' % (adid, digest, offset, length)
+
+def read_chunk_index(path):
+    '''
+    Reads the index of the chunk at path, see IndexedChunk, into
+    adid |--> (digest, offset, length). An adid indexed more than once
+    gets its last entry. Entries cut short by an interrupted run, or
+    past the end of the chunk, are ignored.
+    '''
+    index = {}
+    if not os.path.exists(path) or not os.path.exists(index_path(path)):
+        return index
+    size = os.path.getsize(path)
+    with io.open(index_path(path), encoding='utf-8') as findex:
+        for line in findex:
+            fields = line.rstrip(u'\n').split(u'\t')
+            if not line.endswith(u'\n') or len(fields) != 4:
+                continue
+            adid, digest, offset, length = fields
+            offset, length = int(offset), int(length)
+            if offset + length <= size:
+                index[adid] = (digest, offset, length)
+    return index
+
+class IndexedChunk(object):
+    '''
+    Appends FCs to the chunk at path, creating it if need be, and
+    records each in the index at index_path(path) with a line
+    ``adid<TAB>digest<TAB>offset<TAB>length``: the fc_digest of the ad
+    and the FC's byte range in the chunk. An ad whose FC is added again
+    is only re-indexed; its old FC stays in the chunk until
+    compact_chunk.
+
+    Has the add and flush of a chunk, so write_fc can write to it.
+    Like a chunk, mode 'wb' refuses to overwrite an existing path; mode
+    'ab' refuses an existing path without an index, whose FCs could
+    not be told apart from those appended. Compressed chunks have no
+    byte offsets, so path cannot end in .gz or .xz.
+    '''
+    def __init__(self, path, transforms, mode='ab'):
+        if path.endswith(('.gz', '.xz')):
+            raise ValueError('cannot index compressed chunk %s' % path)
+        if mode == 'wb' and os.path.exists(path):
+            raise IOError(errno.EEXIST,
+                          'mode=%r would overwrite existing %s' % (mode, path))
+        if os.path.exists(path) and not os.path.exists(index_path(path)):
+            raise IOError(errno.EEXIST, 'existing %s has no index %s'
+                          % (path, index_path(path)))
+        self.path = path
+        self.transforms = transforms
+        self.index = read_chunk_index(path)
+        self.fh = open(path, 'ab')
+        self.fh.seek(0, os.SEEK_END)
+        self.chunk = FeatureCollectionCborChunk(file_obj=self.fh, mode='ab')
+        # an index without its chunk is stale
+        self.findex = io.open(index_path(path), 'a' if self.index else 'w',
+                              encoding='utf-8')
+
+    def unchanged(self, adid, attrvals):
+        '''
+        True if the chunk has the FC of this adid for these attrvals and
+        transforms
+        '''
+        digest = fc_digest(json.dumps(attrvals).decode('utf-8'),
+                           self.transforms)
+        return self.index.get(adid, (None,))[0] == digest
+
+    def add(self, fc):
+        adid = fc['adid']
+        digest = fc_digest(fc['attrvals'], self.transforms)
+        offset = self.fh.tell()
+        self.chunk.add(fc)
+        length = self.fh.tell() - offset
+        self.index[adid] = (digest, offset, length)
+        self.findex.write(index_line(adid, digest, offset, length))
+
+    def flush(self):
+        # the FCs first, so the index never points past them
+        self.chunk.flush()
+        self.findex.flush()
+
+    def close(self):
+        self.flush()
+        self.chunk.close()
+        self.findex.close()
+        write_chunk_lookup(self.path, self.index)
+
+def compact_chunk(path):
+    '''
+    Rewrites the chunk at path and its index with only the indexed FC of
+    each ad, in chunk order, dropping the FCs replaced by later runs.
+    The FCs are copied without decoding them.
+    '''
+    index = read_chunk_index(path)
+    entries = sorted(index.iteritems(), key=lambda entry: entry[1][1])
+    compacted = path + '.compact'
+    with open(path, 'rb') as fin, open(compacted, 'wb') as fout, \
+            io.open(index_path(compacted), 'w', encoding='utf-8') as findex:
+        for adid, (digest, offset, length) in entries:
+            fin.seek(offset)
+            index[adid] = (digest, fout.tell(), length)
+            findex.write(index_line(adid, digest, fout.tell(), length))
+            fout.write(fin.read(length))
+    # without an index the chunk is rebuilt rather than misread, should
+    # this be interrupted between the renames
+    os.unlink(index_path(path))
+    os.rename(compacted, path)
+    os.rename(index_path(compacted), index_path(path))
+    write_chunk_lookup(path, index)
+
+def merge_indexed_chunks(paths, path):
+    '''
+    Concatenates the indexed chunks at paths, in order, into one indexed
+    chunk at path, copying the FCs without decoding them
+    '''
+    if os.path.exists(path):
+        raise IOError(errno.EEXIST, 'would overwrite existing %s' % path)
+    merged = {}
+    with open(path, 'wb') as fout, \
+            io.open(index_path(path), 'w', encoding='utf-8') as findex:
+        for shard in paths:
+            base = fout.tell()
+            index = read_chunk_index(shard)
+            entries = sorted(index.iteritems(), key=lambda entry: entry[1][1])
+            for adid, (digest, offset, length) in entries:
+                merged[adid] = (digest, base + offset, length)
+                findex.write(index_line(adid, digest, base + offset, length))
+            with open(shard, 'rb') as fin:
+                shutil.copyfileobj(fin, fout)
+    write_chunk_lookup(path, merged)
+
+def lookup_path(path, name=''):
+    return os.path.join(path + '.lookup', name)
+
+def lookup_entries(index):
+    '''
+    The (utf-8 adid, offset, length) of each adid of a chunk index, see
+    read_chunk_index, sorted by adid
+    '''
+    return sorted((adid.encode('utf-8'), offset, length)
+                  for adid, (digest, offset, length) in index.iteritems())
+
+def write_chunk_lookup(path, index=None):
+    '''
+    Writes the lookup of the indexed chunk at path, which ChunkReader
+    memory-maps to find FCs by adid, from its index (default:
+    read_chunk_index(path)). Each lookup is written to a new directory
+    in lookup_path(path), with
+
+    - ``adids``: the indexed adids, utf-8, one per line, sorted
+    - ``adid_offsets``: the n + 1 offsets of the lines of adids
+    - ``offsets``: the high and low 32 bits of the offset in the chunk
+      of the FC of each adid
+    - ``lengths``: the length of the FC of each adid
+
+    The binary files are arrays of native unsigned 32 bit ints. Once
+    they are complete, ``lookup.json`` in lookup_path(path) is replaced
+    by one naming the new directory and the size of the chunk it was
+    written for, and the previous lookup is removed. Files are never
+    rewritten in place, so readers that have mapped the previous lookup
+    can go on reading it.
+
+    :type index: adid |--> (digest, offset, length)
+    '''
+    if index is None:
+        index = read_chunk_index(path)
+    if not os.path.isdir(lookup_path(path)):
+        os.makedirs(lookup_path(path))
+    previous = read_lookup_meta(path)
+    name = 'lookup-%d-%08x' % (os.getpid(), random.getrandbits(32))
+    os.mkdir(lookup_path(path, name))
+    adid_offsets = array('I', [0])
+    offsets = array('I')
+    lengths = array('I')
+    with open(lookup_path(path, os.path.join(name, 'adids')), 'wb') as f:
+        for adid, offset, length in lookup_entries(index):
+            f.write(adid + b'\n')
+            adid_offsets.append(adid_offsets[-1] + len(adid) + 1)
+            offsets.extend((offset >> 32, offset & 0xffffffff))
+            lengths.append(length)
+    for filename, ids in [('adid_offsets', adid_offsets),
+                          ('offsets', offsets), ('lengths', lengths)]:
+        with open(lookup_path(path, os.path.join(name, filename)), 'wb') as f:
+            ids.tofile(f)
+    meta = lookup_path(path, 'lookup.json')
+    with open(meta + '.' + name, 'w') as f:
+        json.dump({'name': name, 'chunk_size': os.path.getsize(path)}, f)
+    os.rename(meta + '.' + name, meta)
+    if previous is not None and previous['name'] != name:
+        shutil.rmtree(lookup_path(path, previous['name']), ignore_errors=True)
+
+def read_lookup_meta(path):
+    '''
+    The lookup.json of the chunk at path, see write_chunk_lookup, or
+    None
+    '''
+    try:
+        with open(lookup_path(path, 'lookup.json')) as f:
+            return json.load(f)
+    except IOError:
+        return None
+
+class MappedLines(object):
+    '''
+    The lines of a memory-mapped file, without their newlines, by the
+    MappedIds of their offsets, passed through decode if given
+    '''
+    def __init__(self, path, offsets, decode=None):
+        self.fh = open(path, 'rb')
+        if os.fstat(self.fh.fileno()).st_size:
+            self.mm = mmap.mmap(self.fh.fileno(), 0, access=mmap.ACCESS_READ)
+        else:
+            self.mm = None
+        self.offsets = offsets
+        self.decode = decode
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        start, end = self.offsets.slice(i, i + 2)
+        line = self.mm[start:end - 1]
+        return line if self.decode is None else self.decode(line)
+
+    def close(self):
+        if self.mm is not None:
+            self.mm.close()
+        self.fh.close()
+        self.offsets.close()
+
+class MappedLookup(object):
+    '''
+    The lookup of a chunk written by write_chunk_lookup, memory-mapped
+
+    :type path: str, the directory of the lookup
+    '''
+    def __init__(self, path):
+        self.adids = MappedLines(os.path.join(path, 'adids'),
+                                 MappedIds(os.path.join(path, 'adid_offsets')))
+        self.offsets = MappedIds(os.path.join(path, 'offsets'))
+        self.lengths = MappedIds(os.path.join(path, 'lengths'))
+
+    def entry(self, i):
+        '''
+        The (offset, length) in the chunk of the FC of adids[i]
+        '''
+        high, low = self.offsets.slice(2 * i, 2 * i + 2)
+        return high << 32 | low, self.lengths[i]
+
+    def close(self):
+        self.adids.close()
+        self.offsets.close()
+        self.lengths.close()
+
+class IndexLookup(object):
+    '''
+    The lookup of a chunk built in memory from its index, for a chunk
+    without a current lookup
+
+    :type index: adid |--> (digest, offset, length)
+    '''
+    def __init__(self, index):
+        entries = lookup_entries(index)
+        self.adids = [adid for adid, offset, length in entries]
+        self.entries = [(offset, length) for adid, offset, length in entries]
+
+    def entry(self, i):
+        return self.entries[i]
+
+    def close(self):
+        pass
+
+def open_chunk_lookup(path):
+    '''
+    The MappedLookup of the chunk at path if it is current, else its
+    IndexLookup. Raises IOError if the chunk has no index.
+    '''
+    if not os.path.exists(index_path(path)):
+        raise IOError(errno.ENOENT, 'no index %s' % index_path(path))
+    meta = read_lookup_meta(path)
+    if meta is not None and meta['chunk_size'] == os.path.getsize(path):
+        try:
+            return MappedLookup(lookup_path(path, meta['name']))
+        except IOError:
+            # replaced by a newer lookup since meta was read
+            pass
+    return IndexLookup(read_chunk_index(path))
+
+class ChunkReader(object):
+    '''
+    Random access by adid to the FCs of an indexed chunk, see
+    IndexedChunk. The chunk and its lookup, see write_chunk_lookup, are
+    memory-mapped, adids are found by bisecting the sorted adids of the
+    lookup, and only the FCs asked for are decoded. An adid indexed
+    more than once gets its last FC. Without a lookup written for the
+    chunk as it is, the index is read into memory instead; the reader
+    never writes. Raises IOError if the chunk has no index.
+
+    :type path: str
+    '''
+    def __init__(self, path):
+        self.lookup = open_chunk_lookup(path)
+        self.adids = self.lookup.adids
+        self.fh = open(path, 'rb')
+        if os.fstat(self.fh.fileno()).st_size:
+            self.mm = mmap.mmap(self.fh.fileno(), 0, access=mmap.ACCESS_READ)
+        else:
+            # mmap refuses empty files, and there is nothing to read
+            self.mm = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __len__(self):
+        return len(self.adids)
+
+    def __iter__(self):
+        for i in xrange(len(self.adids)):
+            yield self.adids[i].decode('utf-8')
+
+    def __contains__(self, adid):
+        return self.position(adid) is not None
+
+    def __getitem__(self, adid):
+        i = self.position(adid)
+        if i is None:
+            raise KeyError(adid)
+        return self.decode(*self.entry(i))
+
+    def position(self, adid):
+        '''
+        The position of adid in the lookup, or None
+        '''
+        if isinstance(adid, unicode):
+            adid = adid.encode('utf-8')
+        i = bisect.bisect_left(self.adids, adid)
+        if i < len(self.adids) and self.adids[i] == adid:
+            return i
+        return None
+
+    def entry(self, i):
+        '''
+        The (offset, length) in the chunk of the FC at position i
+        '''
+        return self.lookup.entry(i)
+
+    def decode(self, offset, length):
+        return FeatureCollection.from_dict(
+            cbor.loads(self.mm[offset:offset + length]))
+
+    def get(self, adid, default=None):
+        i = self.position(adid)
+        if i is None:
+            return default
+        return self.decode(*self.entry(i))
+
+    def get_many(self, adids):
+        '''
+        Yields (adid, fc) for each of adids in the chunk, in chunk order
+        so that the pages are read sequentially. Unknown adids are
+        skipped.
+        '''
+        entries = []
+        for adid in set(adids):
+            i = self.position(adid)
+            if i is not None:
+                entries.append((self.entry(i), adid))
+        entries.sort()
+        for (offset, length), adid in entries:
+            yield adid, self.decode(offset, length)
+
+    def iteritems(self):
+        '''
+        Yields (adid, fc) for every ad of the chunk, in chunk order
+        '''
+        entries = sorted((self.entry(i), i) for i in xrange(len(self)))
+        for (offset, length), i in entries:
+            yield self.adids[i].decode('utf-8'), self.decode(offset, length)
+
+    def close(self):
+        if self.mm is not None:
+            self.mm.close()
+        self.fh.close()
+        self.lookup.close()
+
+def links_path(path, name=''):
+    return os.path.join(path + '.links', name)
+
+def compressed_rows(rows, cols, nrows):
+    '''
+    Groups the (row, col) pairs of rows and cols by row, in the order
+    given. Returns the array of cols and the array of nrows + 1 offsets
+    of each row's cols in it.
+
+    :type rows: array('I')
+    :type cols: array('I')
+    '''
+    offsets = array('I', [0]) * (nrows + 1)
+    for row in rows:
+        offsets[row + 1] += 1
+    for row in xrange(nrows):
+        offsets[row + 1] += offsets[row]
+    grouped = array('I', [0]) * len(cols)
+    cursors = offsets[:-1]
+    for row, col in izip(rows, cols):
+        grouped[cursors[row]] = col
+        cursors[row] += 1
+    return grouped, offsets
+
+def sort_rows(cols, offsets):
+    '''
+    Sorts the cols of each row from compressed_rows and drops repeats
+    '''
+    sorted_cols = array('I')
+    sorted_offsets = array('I', [0])
+    for row in xrange(len(offsets) - 1):
+        sorted_cols.extend(sorted(set(cols[offsets[row]:offsets[row + 1]])))
+        sorted_offsets.append(len(sorted_cols))
+    return sorted_cols, sorted_offsets
+
+class LinkIndexWriter(object):
+    '''
+    Builds the inverted index of the ads by their mentioned values that
+    LinkIndex reads, from the (adid, attrvals) it is given, and writes it
+    to the directory links_path(path):
+
+    - ``adids``: one adid per line, line n is the ad with id n, with
+      ``adids_offsets`` and ``adid_order``, see write_adids
+    - ``keys``: one json [featname, featval] per line, sorted, line n is
+      the key with id n, with ``keys_offsets``, see write_lines
+    - ``postings`` and ``posting_offsets``: the sorted ids of the ads
+      mentioning each key are postings[offsets[key]:offsets[key + 1]]
+    - ``features`` and ``feature_offsets``: likewise the sorted ids of
+      the keys each ad mentions
+
+    The binary files are arrays of native unsigned 32 bit ints. Memory
+    is 8 bytes per distinct key of an ad, plus the adids and keys.
+    LinkIndex memory-maps all of them.
+    '''
+    def __init__(self):
+        self.adids = []
+        self.adid_ids = {}
+        self.keys = []
+        self.key_ids = {}
+        # one (ad id, key id) pair per distinct value of an ad
+        self.ads = array('I')
+        self.ad_keys = array('I')
+        # whether an adid was given twice, so its pairs are not in order
+        self.repeated = False
+
+    def add(self, adid, attrvals):
+        '''
+        :type attrvals: featname |--> [featval]
+        '''
+        ad_id = self.adid_ids.get(adid)
+        if ad_id is None:
+            ad_id = self.adid_ids[adid] = len(self.adids)
+            self.adids.append(adid)
+        else:
+            self.repeated = True
+        for featname, vals in attrvals.iteritems():
+            for featval in set(vals):
+                key = (featname, featval)
+                key_id = self.key_ids.get(key)
+                if key_id is None:
+                    key_id = self.key_ids[key] = len(self.keys)
+                    self.keys.append(key)
+                self.ads.append(ad_id)
+                self.ad_keys.append(key_id)
+
+    def indexed(self, grouped):
+        '''
+        Yields the (adid, attrvals) of grouped, adding each
+        '''
+        for adid, attrvals in grouped:
+            self.add(adid, attrvals)
+            yield adid, attrvals
+
+    def write(self, path):
+        '''
+        Writes the index of the ads added so far for the chunk at path
+        '''
+        order = sorted(xrange(len(self.keys)), key=self.keys.__getitem__)
+        # key id |--> sorted key id
+        renumbered = array('I', [0]) * len(order)
+        for sorted_id, key_id in enumerate(order):
+            renumbered[key_id] = sorted_id
+        keys = array('I', (renumbered[key_id] for key_id in self.ad_keys))
+
+        # ads are added in id order and each key once per ad, so only
+        # repeated adids leave the postings unsorted
+        postings, posting_offsets = compressed_rows(keys, self.ads, len(order))
+        features, feature_offsets = compressed_rows(self.ads, keys,
+                                                    len(self.adids))
+        features, feature_offsets = sort_rows(features, feature_offsets)
+        if self.repeated:
+            postings, posting_offsets = sort_rows(postings, posting_offsets)
+
+        if not os.path.isdir(links_path(path)):
+            os.makedirs(links_path(path))
+        write_adids(links_path(path), self.adids)
+        write_lines(links_path(path, 'keys'),
+                    (json.dumps(self.keys[key_id]).decode('utf-8')
+                     for key_id in order))
+        for name, ids in [('postings', postings),
+                          ('posting_offsets', posting_offsets),
+                          ('features', features),
+                          ('feature_offsets', feature_offsets)]:
+            with open(links_path(path, name), 'wb') as f:
+                ids.tofile(f)
+
+class MappedIds(object):
+    '''
+    A memory-mapped file of native unsigned 32 bit ints, sliced into
+    arrays
+    '''
+    def __init__(self, path):
+        self.fh = open(path, 'rb')
+        if os.fstat(self.fh.fileno()).st_size:
+            self.mm = mmap.mmap(self.fh.fileno(), 0, access=mmap.ACCESS_READ)
+        else:
+            self.mm = None
+
+    def __len__(self):
+        return self.mm.size() // array('I').itemsize if self.mm else 0
+
+    def __getitem__(self, i):
+        return self.slice(i, i + 1)[0]
+
+    def slice(self, start, end):
+        ids = array('I')
+        if start < end:
+            ids.fromstring(self.mm[start * ids.itemsize:end * ids.itemsize])
+        return ids
+
+    def close(self):
+        if self.mm is not None:
+            self.mm.close()
+        self.fh.close()
+
+def write_lines(path, lines):
+    '''
+    Writes the unicode lines to the file at path, utf-8, and the n + 1
+    offsets of the lines in it to path + '_offsets', for MappedLines
+    '''
+    offsets = array('I', [0])
+    with open(path, 'wb') as f:
+        for line in lines:
+            line = line.encode('utf-8') + b'\n'
+            f.write(line)
+            offsets.append(offsets[-1] + len(line))
+    with open(path + '_offsets', 'wb') as f:
+        offsets.tofile(f)
+
+def write_adids(path, adids):
+    '''
+    Writes the adids of an index, in ad id order, to the directory path,
+    for MappedAdids: ``adids``, one per line, and its
+    ``adids_offsets``, see write_lines, and ``adid_order``, the ad ids
+    in the order of their adids
+    '''
+    write_lines(os.path.join(path, 'adids'), adids)
+    encoded = [adid.encode('utf-8') for adid in adids]
+    order = array('I', sorted(xrange(len(encoded)), key=encoded.__getitem__))
+    with open(os.path.join(path, 'adid_order'), 'wb') as f:
+        order.tofile(f)
+
+class Permuted(object):
+    '''
+    The items of a sequence in the order of the MappedIds of their
+    positions, for bisect
+    '''
+    def __init__(self, items, order):
+        self.items = items
+        self.order = order
+
+    def __len__(self):
+        return len(self.order)
+
+    def __getitem__(self, i):
+        return self.items[self.order[i]]
+
+class MappedAdids(object):
+    '''
+    The adids of an index written by write_adids to the directory
+    path, memory-mapped: adids[ad_id] is the adid of an ad id, and
+    ad_id finds the ad id of an adid by bisecting them in adid order
+    '''
+    def __init__(self, path):
+        self.lines = MappedLines(
+            os.path.join(path, 'adids'),
+            MappedIds(os.path.join(path, 'adids_offsets')))
+        self.order = MappedIds(os.path.join(path, 'adid_order'))
+        self.sorted = Permuted(self.lines, self.order)
+
+    def __len__(self):
+        return len(self.lines)
+
+    def __getitem__(self, ad_id):
+        return self.lines[ad_id].decode('utf-8')
+
+    def ad_id(self, adid):
+        '''
+        The ad id of adid, or None
+        '''
+        if isinstance(adid, unicode):
+            adid = adid.encode('utf-8')
+        i = bisect.bisect_left(self.sorted, adid)
+        if i < len(self.sorted) and self.sorted[i] == adid:
+            return self.order[i]
+        return None
+
+    def close(self):
+        self.lines.close()
+        self.order.close()
+
+def decode_key(line):
+    return tuple(json.loads(line))
+
+class LinkIndex(object):
+    '''
+    The ads of an FC chunk by the values they mention, as written by
+    LinkIndexWriter with --links. Everything is memory-mapped: adids
+    and keys are found by bisecting their sorted lines, so opening the
+    index reads none of it.
+
+    :type path: str, the path of the FC chunk
+    '''
+    def __init__(self, path):
+        self.adids = MappedAdids(links_path(path))
+        self.keys = MappedLines(links_path(path, 'keys'),
+                                MappedIds(links_path(path, 'keys_offsets')),
+                                decode=decode_key)
+        self.postings = MappedIds(links_path(path, 'postings'))
+        self.posting_offsets = MappedIds(links_path(path, 'posting_offsets'))
+        self.features = MappedIds(links_path(path, 'features'))
+        self.feature_offsets = MappedIds(links_path(path, 'feature_offsets'))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __len__(self):
+        return len(self.adids)
+
+    def __contains__(self, adid):
+        return self.adids.ad_id(adid) is not None
+
+    def key_id(self, key):
+        '''
+        The key id of (featname, featval), or None
+        '''
+        i = bisect.bisect_left(self.keys, key)
+        if i < len(self.keys) and self.keys[i] == key:
+            return i
+        return None
+
+    def ad_ids(self, key_id):
+        start, end = self.posting_offsets.slice(key_id, key_id + 2)
+        return self.postings.slice(start, end)
+
+    def key_ids_of(self, ad_id):
+        start, end = self.feature_offsets.slice(ad_id, ad_id + 2)
+        return self.features.slice(start, end)
+
+    def ads_with(self, featname, featval):
+        '''
+        Returns the adids of the ads mentioning featval as featname
+        '''
+        key_id = self.key_id((featname, featval))
+        if key_id is None:
+            return []
+        return [self.adids[ad_id] for ad_id in self.ad_ids(key_id)]
+
+    def features_of(self, adid):
+        '''
+        Returns the sorted (featname, featval) mentioned by an ad
+        '''
+        ad_id = self.adids.ad_id(adid)
+        if ad_id is None:
+            return []
+        return [self.keys[key_id] for key_id in self.key_ids_of(ad_id)]
+
+    def linked_ads(self, adid, featnames=None):
+        '''
+        Returns the other ads mentioning any of the values mentioned by
+        adid, optionally only those of featnames, as
+        adid |--> [(featname, featval) shared]
+        '''
+        ad_id = self.adids.ad_id(adid)
+        if ad_id is None:
+            return {}
+        linked = {}
+        for key_id in self.key_ids_of(ad_id):
+            key = self.keys[key_id]
+            if featnames is not None and key[0] not in featnames:
+                continue
+            for other_id in self.ad_ids(key_id):
+                if other_id != ad_id:
+                    linked.setdefault(self.adids[other_id], []).append(key)
+        return linked
+
+    def close(self):
+        self.adids.close()
+        self.keys.close()
+        for ids in [self.postings, self.posting_offsets,
+                    self.features, self.feature_offsets]:
+            ids.close()
+
+def iter_chunk_fcs(path):
+    '''
+    Yields the FCs of the chunk at path, one at a time. Of an indexed
+    chunk, yields only the indexed FC of each ad.
+    '''
+    if os.path.exists(index_path(path)):
+        with ChunkReader(path) as reader:
+            for adid, fc in reader.iteritems():
+                yield fc
+    else:
+        for fc in FeatureCollectionCborChunk(path=path, mode='rb'):
+            yield fc
+
+class CsrExport(object):
+    '''
+    Collects the StringCounter features of FCs, a row per FC, into
+    sparse matrices in CSR form, one per feature (bosb and each
+    attribute with trans_features), over a vocabulary of feature values
+    shared by all of them. Only the matrices are kept, not the FCs.
+
+    write puts them in a directory, which load_csr reads into scipy:
+
+    - ``adids``: one adid per line, line n is row n
+    - ``vocabulary``: one json feature value per line, line n is
+      column n
+    - ``<feature>.indptr``, ``<feature>.indices``, ``<feature>.data``:
+      the arrays of the csr_matrix of feature, native 32 bit ints
+    - ``matrices.json``: the shape of the matrices, the byte order and
+      the file name of each feature
+    '''
+    def __init__(self, skip=('NAME',)):
+        self.skip = set(skip)
+        self.adids = []
+        self.vocabulary = []
+        self.columns = {}
+        # feature |--> (indptr, indices, data)
+        self.matrices = {}
+
+    def column(self, value):
+        column = self.columns.get(value)
+        if column is None:
+            column = self.columns[value] = len(self.vocabulary)
+            self.vocabulary.append(value)
+        return column
+
+    def add(self, fc):
+        row = len(self.adids)
+        self.adids.append(fc['adid'])
+        for feature, counter in fc.iteritems():
+            if feature in self.skip or not isinstance(counter, StringCounter):
+                continue
+            matrix = self.matrices.get(feature)
+            if matrix is None:
+                matrix = self.matrices[feature] = \
+                    (array('i', [0]), array('i'), array('i'))
+            indptr, indices, data = matrix
+            # the rows of FCs without this feature are empty
+            indptr.extend([indptr[-1]] * (row + 1 - len(indptr)))
+            for column, count in sorted((self.column(value), count)
+                                        for value, count in counter.items()):
+                indices.append(column)
+                data.append(count)
+            indptr.append(len(indices))
+
+    def write(self, path):
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        with io.open(os.path.join(path, 'adids'), 'w', encoding='utf-8') as f:
+            for adid in self.adids:
+                f.write(adid + u'\n')
+        with io.open(os.path.join(path, 'vocabulary'), 'w',
+                     encoding='utf-8') as f:
+            for value in self.vocabulary:
+                f.write(json.dumps(value).decode('utf-8') + u'\n')
+        files = {}
+        for i, (feature, arrays) in enumerate(sorted(self.matrices.items())):
+            indptr, indices, data = arrays
+            indptr.extend([indptr[-1]] * (len(self.adids) + 1 - len(indptr)))
+            files[feature] = '%03d-%s' % (i, re.sub(r'[^\w.-]', '_', feature))
+            for suffix, ids in [('indptr', indptr), ('indices', indices),
+                                ('data', data)]:
+                name = '%s.%s' % (files[feature], suffix)
+                with open(os.path.join(path, name), 'wb') as f:
+                    ids.tofile(f)
+        with open(os.path.join(path, 'matrices.json'), 'w') as f:
+            json.dump({
+                'shape': [len(self.adids), len(self.vocabulary)],
+                'byteorder': sys.byteorder,
+                'files': files,
+            }, f, indent=2, sort_keys=True)
+
+def load_csr(path, features=None):
+    '''
+    Reads the matrices written by CsrExport to the directory path.
+    Returns (adids, vocabulary, feature |--> scipy.sparse.csr_matrix),
+    with only the matrices of features if given.
+
+    Needs numpy and scipy, which the rest of this script does not.
+    '''
+    import numpy
+    import scipy.sparse
+
+    with io.open(os.path.join(path, 'adids'), encoding='utf-8') as f:
+        adids = [line.rstrip(u'\n') for line in f]
+    with io.open(os.path.join(path, 'vocabulary'), encoding='utf-8') as f:
+        vocabulary = [json.loads(line) for line in f]
+    with open(os.path.join(path, 'matrices.json')) as f:
+        meta = json.load(f)
+    dtype = numpy.dtype('int32').newbyteorder(
+        '<' if meta['byteorder'] == 'little' else '>')
+    matrices = {}
+    for feature, name in meta['files'].iteritems():
+        if features is not None and feature not in features:
+            continue
+        indptr, indices, data = [
+            numpy.fromfile(os.path.join(path, '%s.%s' % (name, suffix)),
+                           dtype=dtype)
+            for suffix in ['indptr', 'indices', 'data']]
+        matrices[feature] = scipy.sparse.csr_matrix(
+            (data, indices, indptr), shape=tuple(meta['shape']))
+    return adids, vocabulary, matrices
+
+def lsh_bands(threshold, permutations=MINHASH_PERMUTATIONS):
+    '''
+    Returns the (bands, rows) splitting the signatures for LSH: of the
+    splits whose S-curve threshold (1 / bands) ** (1 / rows) is at most
+    threshold, so few pairs above it are missed, the one with the most
+    rows, so the fewest false candidates
+    '''
+    splits = [(permutations // rows, rows)
+              for rows in range(1, permutations + 1)
+              if permutations % rows == 0]
+    below = [(bands, rows) for bands, rows in splits
+             if (1 / bands) ** (1 / rows) <= threshold]
+    return below[-1] if below else splits[0]
+
+def band_hash(signature, band, rows):
+    return zlib.crc32(signature[band * rows:(band + 1) * rows].tostring()) \
+        & 0xffffffff
+
+def parse_signature(minhash):
+    '''
+    :type minhash: unicode, the fc['minhash'] of trans_minhash
+    '''
+    return array('I', [int(minhash[i:i + 8], 16)
+                       for i in range(0, len(minhash), 8)])
+
+class LshIndexWriter(object):
+    '''
+    Writes the LSH index of MinHash signatures that LshIndex reads to
+    the directory path:
+
+    - ``adids``: one adid per line, line n is the ad with id n, with
+      ``adids_offsets`` and ``adid_order``, see write_adids
+    - ``signatures``: the signature of each ad, in id order
+    - ``band-NNN.hashes`` and ``band-NNN.ads``: the hash of each ad's
+      rows of band NNN, sorted, and the ids of the ads, so that the ads
+      of a bucket are adjacent
+    - ``lsh.json``: the threshold, bands and rows
+
+    The binary files are arrays of native unsigned 32 bit ints. The
+    adids, signatures and hashes go to disk as they are added; close
+    sorts the adids, then the bands one at a time, so memory is bounded
+    by the adids or one band.
+    '''
+    def __init__(self, path, threshold):
+        self.path = path
+        self.threshold = threshold
+        self.bands, self.rows = lsh_bands(threshold)
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        self.ads = 0
+        self.fadids = io.open(os.path.join(path, 'adids'), 'w',
+                              encoding='utf-8')
+        self.fsignatures = open(os.path.join(path, 'signatures'), 'wb')
+        # the hashes of each band, in ad order until close sorts them
+        self.fbands = [open(self.band_path(band) + '.hashes', 'wb')
+                       for band in range(self.bands)]
+
+    def band_path(self, band):
+        return os.path.join(self.path, 'band-%03d' % band)
+
+    def add(self, adid, signature):
+        '''
+        :type signature: array('I'), see minhash_signature
+        '''
+        self.fadids.write(adid + u'\n')
+        signature.tofile(self.fsignatures)
+        for band, f in enumerate(self.fbands):
+            array('I', [band_hash(signature, band, self.rows)]).tofile(f)
+        self.ads += 1
+
+    def close(self):
+        for f in [self.fadids, self.fsignatures] + self.fbands:
+            f.close()
+        with io.open(os.path.join(self.path, 'adids'), encoding='utf-8') as f:
+            write_adids(self.path, [line.rstrip(u'\n') for line in f])
+        for band in range(self.bands):
+            hashes = array('I')
+            with open(self.band_path(band) + '.hashes', 'rb') as f:
+                hashes.fromfile(f, self.ads)
+            # hash and ad id in one int, so the ads of a bucket sort
+            # together and in id order
+            buckets = sorted((bucket << 32) | ad
+                             for ad, bucket in enumerate(hashes))
+            with open(self.band_path(band) + '.hashes', 'wb') as f:
+                array('I', [bucket >> 32 for bucket in buckets]).tofile(f)
+            with open(self.band_path(band) + '.ads', 'wb') as f:
+                array('I', [bucket & 0xffffffff
+                            for bucket in buckets]).tofile(f)
+        with open(os.path.join(self.path, 'lsh.json'), 'w') as f:
+            json.dump({
+                'threshold': self.threshold,
+                'bands': self.bands,
+                'rows': self.rows,
+                'permutations': MINHASH_PERMUTATIONS,
+            }, f, indent=2, sort_keys=True)
+
+class LshIndex(object):
+    '''
+    Near duplicate ads by the LSH index of their MinHash signatures
+    written by LshIndexWriter with --lsh. The adids, signatures and
+    bands are memory-mapped, so opening the index reads none of them.
+
+    Candidates are the ads sharing a bucket in some band; they are kept
+    if the Jaccard similarity estimated from their signatures is at
+    least the threshold.
+
+    :type path: str, the directory of the index
+    '''
+    def __init__(self, path):
+        with open(os.path.join(path, 'lsh.json')) as f:
+            meta = json.load(f)
+        self.threshold = meta['threshold']
+        self.bands = meta['bands']
+        self.rows = meta['rows']
+        self.permutations = meta['permutations']
+        self.adids = MappedAdids(path)
+        self.signatures = MappedIds(os.path.join(path, 'signatures'))
+        self.band_hashes = []
+        self.band_ads = []
+        for band in range(self.bands):
+            name = os.path.join(path, 'band-%03d' % band)
+            self.band_hashes.append(MappedIds(name + '.hashes'))
+            self.band_ads.append(MappedIds(name + '.ads'))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __len__(self):
+        return len(self.adids)
+
+    def signature(self, ad_id):
+        return self.signatures.slice(ad_id * self.permutations,
+                                     (ad_id + 1) * self.permutations)
+
+    def jaccard(self, signature, other):
+        '''
+        The Jaccard similarity estimated from two signatures
+        '''
+        return sum(map(operator.eq, signature, other)) / self.permutations
+
+    def first_band(self, signature, other):
+        '''
+        The first band in which two signatures have the same rows
+        '''
+        for start in range(0, self.permutations, self.rows):
+            end = start + self.rows
+            if signature[start:end] == other[start:end]:
+                return start // self.rows
+        return None
+
+    def similar(self, adid, threshold=None):
+        '''
+        Returns the other ads with an estimated Jaccard similarity to
+        adid of at least threshold, the index's by default, as
+        adid |--> similarity
+        '''
+        threshold = self.threshold if threshold is None else threshold
+        ad_id = self.adids.ad_id(adid)
+        if ad_id is None:
+            return {}
+        signature = self.signature(ad_id)
+        candidates = set()
+        for band in range(self.bands):
+            hashes = self.band_hashes[band]
+            bucket = band_hash(signature, band, self.rows)
+            start = bisect.bisect_left(hashes, bucket)
+            end = bisect.bisect_right(hashes, bucket, start)
+            candidates.update(self.band_ads[band].slice(start, end))
+        candidates.discard(ad_id)
+        similar = {}
+        for other_id in candidates:
+            similarity = self.jaccard(signature, self.signature(other_id))
+            if similarity >= threshold:
+                similar[self.adids[other_id]] = similarity
+        return similar
+
+    def candidate_pairs(self, threshold=None, max_bucket=None):
+        '''
+        Yields (adid, adid, estimated Jaccard similarity) for each pair of
+        ads with the same rows in some band and a similarity of at least
+        threshold, the index's by default, once. Buckets of more than
+        max_bucket ads are skipped.
+
+        A band at a time is read; pairs are yielded in the first band
+        they have the same rows in, so no set of the pairs is kept.
+        '''
+        threshold = self.threshold if threshold is None else threshold
+        for band in range(self.bands):
+            hashes = self.band_hashes[band].slice(0, len(self.adids))
+            ads = self.band_ads[band].slice(0, len(self.adids))
+            start = 0
+            while start < len(hashes):
+                end = start + 1
+                while end < len(hashes) and hashes[end] == hashes[start]:
+                    end += 1
+                if end - start > 1 and (max_bucket is None
+                                        or end - start <= max_bucket):
+                    # tuples compare without boxing each value again
+                    bucket = [(ad_id, tuple(self.signature(ad_id)))
+                              for ad_id in ads[start:end]]
+                    for i, (ad_id, signature) in enumerate(bucket):
+                        for other_id, other in bucket[i + 1:]:
+                            if self.first_band(signature, other) != band:
+                                continue
+                            similarity = self.jaccard(signature, other)
+                            if similarity >= threshold:
+                                yield (self.adids[ad_id],
+                                       self.adids[other_id], similarity)
+                start = end
+
+    def close(self):
+        self.adids.close()
+        self.signatures.close()
+        for ids in self.band_hashes + self.band_ads:
+            ids.close()
 
 if __name__ == '__main__':
     p = argparse.ArgumentParser(
         description='Convert Karma JSON file to FeatureCollections.')
     p.add_argument('karma_json', metavar='JSON_FILE')
     p.add_argument('fc_chunk', metavar='FC_CHUNK_FILE')
-    p.add_argument('--transforms', action='append')
+    p.add_argument('--transforms', action='append', default=[])
     p.add_argument('--overwrite', action='store_true')
+    p.add_argument('--stream', action='store_true',
+                   help='read the json incrementally and write each FC as '
+                        'soon as its ad is read; records of an ad must be '
+                        'consecutive')
+    p.add_argument('--workers', type=int, default=0,
+                   help='run the transforms in this many processes, each '
+                        'writing the shard FC_CHUNK_FILE-NNNNN-of-NNNNN')
+    p.add_argument('--merge', action='store_true',
+                   help='with --workers, merge the shards into FC_CHUNK_FILE')
+    p.add_argument('--index', action='store_true',
+                   help='also write the index FC_CHUNK_FILE.index, which '
+                        'ChunkReader uses to read FCs by adid (--workers '
+                        'indexes each shard)')
+    p.add_argument('--links', action='store_true',
+                   help='also write the index of the ads by the values '
+                        'they mention, which LinkIndex reads, to the '
+                        'directory FC_CHUNK_FILE.links')
+    p.add_argument('--csr', metavar='DIR',
+                   help='then export the StringCounter features of the '
+                        'written FCs as sparse matrices to DIR, see '
+                        'load_csr')
+    p.add_argument('--lsh', metavar='DIR',
+                   help='then index the minhash signatures of the written '
+                        'FCs in DIR, see LshIndex; needs --transforms '
+                        'minhash, after features')
+    p.add_argument('--lsh-threshold', type=float, default=0.5,
+                   help='Jaccard similarity of near duplicate ads for '
+                        '--lsh (default: %(default)s)')
+    p.add_argument('--lsh-pairs', metavar='TSV_FILE',
+                   help='with --lsh, write the near duplicate pairs of '
+                        'ads and their estimated Jaccard similarity')
+    p.add_argument('--incremental', action='store_true',
+                   help='only transform the ads that are new or changed '
+                        'since the last --incremental run and append them '
+                        'to FC_CHUNK_FILE, indexed in FC_CHUNK_FILE.index; '
+                        'ads not in JSON_FILE keep their FCs; an existing '
+                        'FC_CHUNK_FILE without an index needs --overwrite')
+    p.add_argument('--compact', action='store_true',
+                   help='with --incremental, then drop the FCs of changed '
+                        'ads from FC_CHUNK_FILE')
+    p.add_argument('--write-queue', type=int, default=0, metavar='N',
+                   help='serialize and write the FCs on a background '
+                        'thread, through a queue of N FCs')
+    p.add_argument('--rollover-fcs', type=int, metavar='N',
+                   help='write numbered chunks FC_CHUNK_FILE-NNNNN of at '
+                        'most N FCs instead of a single chunk')
+    p.add_argument('--rollover-bytes', type=int, metavar='BYTES',
+                   help='write numbered chunks FC_CHUNK_FILE-NNNNN of '
+                        'about BYTES bytes instead of a single chunk')
+    p.add_argument('--compress', action='store_true',
+                   help='with --rollover-fcs or --rollover-bytes, gzip '
+                        'the chunks, named FC_CHUNK_FILE-NNNNN.gz')
+    p.add_argument('--stats', action='store_true',
+                   help='time each stage and transform and print a summary '
+                        'to stderr')
+    p.add_argument('--stats-output', metavar='JSON_FILE',
+                   help='also write the --stats report as json')
     args = p.parse_args()
+    if args.incremental and args.workers:
+        p.error('--incremental cannot be used with --workers')
+    if args.compact and not args.incremental:
+        p.error('--compact requires --incremental')
+    if args.lsh and 'minhash' not in args.transforms:
+        p.error('--lsh requires --transforms minhash')
+    if args.lsh_pairs and not args.lsh:
+        p.error('--lsh-pairs requires --lsh')
+    rollover = args.rollover_fcs or args.rollover_bytes
+    if rollover and (args.workers or args.index or args.incremental):
+        p.error('--rollover-fcs and --rollover-bytes cannot be used with '
+                '--workers, --index or --incremental')
+    if args.compress and not rollover:
+        p.error('--compress requires --rollover-fcs or --rollover-bytes')
+    if args.write_queue and args.workers:
+        p.error('--write-queue cannot be used with --workers')
+    stats = PipelineStats() if args.stats or args.stats_output else None
+    started = time.time()
 
     if args.overwrite:
-        try:
-            os.unlink(args.fc_chunk)
-        except OSError:
-            pass
+        paths = [args.fc_chunk, index_path(args.fc_chunk)]
+        for i in range(args.workers):
+            shard = shard_path(args.fc_chunk, i, args.workers)
+            paths += [shard, index_path(shard)]
+            shutil.rmtree(lookup_path(shard), ignore_errors=True)
+        for suffix in ['', '.gz', '.part', '.gz.part']:
+            paths += glob.glob(args.fc_chunk + '-' + '[0-9]' * 5 + suffix)
+        for path in paths:
+            try:
+                os.unlink(path)
+            except OSError:
+                pass
+        shutil.rmtree(links_path(args.fc_chunk), ignore_errors=True)
+        shutil.rmtree(lookup_path(args.fc_chunk), ignore_errors=True)
+
+    fjson = open(args.karma_json)
+    if args.stream:
+        grouped = gen_mentions_as_features(fjson, stats)
+        if stats is not None:
+            grouped = stats.timed('read', grouped)
+    else:
+        start = time.time()
+        store = group_mentions_as_features(fjson, stats)
+        grouped = store.iteritems()
+        if args.workers:
+            # sorted, so that every shard has the same order in every run;
+            # only the adids, so that the attrvals are built one at a time
+            grouped = ((adid, store[adid]) for adid in sorted(store))
+        if stats is not None:
+            stats.lap('read', start)
+    if args.links:
+        links = LinkIndexWriter()
+        grouped = links.indexed(grouped)
+
+    if args.workers:
+        if args.merge:
+            check_writable(args.fc_chunk)
+        paths = write_sharded(grouped, args.fc_chunk, args.transforms,
+                              args.workers, stats=stats, index=args.index)
+        if args.merge:
+            start = time.time()
+            if args.index:
+                merge_indexed_chunks(paths, args.fc_chunk)
+                for path in paths:
+                    os.unlink(index_path(path))
+                    shutil.rmtree(lookup_path(path))
+            else:
+                merge_chunks(paths, args.fc_chunk)
+            for path in paths:
+                os.unlink(path)
+            if stats is not None:
+                stats.lap('merge', start)
+    elif args.incremental:
+        indexed = chunk = IndexedChunk(args.fc_chunk, args.transforms)
+        if args.write_queue:
+            chunk = BackgroundChunk(indexed, args.write_queue, stats)
+        for adid, attrvals in grouped:
+            if indexed.unchanged(adid, attrvals):
+                if stats is not None:
+                    stats.unchanged += 1
+                continue
+            write_fc(chunk, adid, attrvals, args.transforms, stats)
+        chunk.close()
+        if args.compact:
+            start = time.time()
+            compact_chunk(args.fc_chunk)
+            if stats is not None:
+                stats.lap('compact', start)
+    else:
+        if args.index:
+            chunk = IndexedChunk(args.fc_chunk, args.transforms, mode='wb')
+        elif rollover:
+            rolling = chunk = RollingChunk(args.fc_chunk, args.rollover_bytes,
+                                           args.rollover_fcs, args.compress)
+        else:
+            chunk = FeatureCollectionCborChunk(path=args.fc_chunk, mode='wb')
+        if args.write_queue:
+            chunk = BackgroundChunk(chunk, args.write_queue, stats)
+        for adid, attrvals in grouped:
+            write_fc(chunk, adid, attrvals, args.transforms, stats)
+        chunk.close()
+    fjson.close()
+    if args.workers and not args.merge:
+        chunk_paths = paths
+    elif rollover:
+        chunk_paths = rolling.paths
+    else:
+        chunk_paths = [args.fc_chunk]
+    if args.csr:
+        start = time.time()
+        export = CsrExport()
+        for path in chunk_paths:
+            for fc in iter_chunk_fcs(path):
+                export.add(fc)
+        export.write(args.csr)
+        if stats is not None:
+            stats.lap('csr', start)
+    if args.lsh:
+        start = time.time()
+        lsh = LshIndexWriter(args.lsh, args.lsh_threshold)
+        for path in chunk_paths:
+            for fc in iter_chunk_fcs(path):
+                if 'minhash' in fc:
+                    lsh.add(fc['adid'], parse_signature(fc['minhash']))
+        lsh.close()
+        if args.lsh_pairs:
+            with LshIndex(args.lsh) as index, \
+                    io.open(args.lsh_pairs, 'w', encoding='utf-8') as fpairs:
+                for adid, other, similarity in index.candidate_pairs():
+                    fpairs.write(u'%s\t%s\t%.4f\n' % (adid, other, similarity))
+        if stats is not None:
+            stats.lap('lsh', start)
+    if args.links:
+        start = time.time()
+        links.write(args.fc_chunk)
+        if stats is not None:
+            stats.lap('links', start)
 
-    with open(args.karma_json) as fjson:
-        grouped = group_mentions_as_features(fjson)
-
-    chunk = FeatureCollectionCborChunk(path=args.fc_chunk, mode='wb')
-    for adid, attrvals in grouped.iteritems():
-        fc = FeatureCollection()
-        fc['adid'] = adid
-        fc['attrvals'] = json.dumps(attrvals).decode('utf-8')
-        fc['NAME'] = StringCounter({adid: 1})
-        for trans in args.transforms:
-            globals()['trans_%s' % trans](fc, adid, attrvals)
-        chunk.add(fc)
-    chunk.flush()
\ No newline at end of file
+    if stats is not None:
+        stats.lap('total', started)
+        if args.stats_output:
+            with open(args.stats_output, 'w') as fstats:
+                json.dump(stats.report(), fstats, indent=2, sort_keys=True)
+        print(stats.summary(), file=sys.stderr)
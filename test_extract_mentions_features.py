@@ -0,0 +1,384 @@
+'''
+Tests of extract-mentions-features.py, loaded as a module
+'''
+
+from __future__ import absolute_import, division, print_function
+
+import errno
+import imp
+import io
+import json
+import multiprocessing
+import os
+import random
+
+import pytest
+from dossier.fc import FeatureCollectionCborChunk
+
+emf = imp.load_source(
+    'extract_mentions_features',
+    os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                 'extract-mentions-features.py'))
+
+ITEMS = [
+    {'@id': 'ad1', 'schema:mentions': {'memex:feature': 'x/cup/dd'}},
+    {'@id': 'ad2', 'schema:mentions': [
+        {'memex:feature': 'x/PhoneNumber/2135551212'},
+        {'memex:feature': 'x/PersonName/ana, "ana" [2]'}]},
+    {'@id': 'ad3', 'note': u'caf\xe9 ' * 50, 'n': 12345},
+    12345,
+    [],
+    {},
+]
+
+def as_array(items):
+    return '[\n' + ',\n'.join(json.dumps(item) for item in items) + '\n]\n'
+
+def as_jsonlines(items):
+    return ''.join(json.dumps(item) + '\n' for item in items)
+
+def as_concatenated(items):
+    return ''.join(json.dumps(item) for item in items)
+
+def read_items(text, chunk_size=1 << 16):
+    return list(emf.iter_karma_items(io.BytesIO(text), chunk_size))
+
+@pytest.mark.parametrize('chunk_size', [1, 2, 3, 7, 64, 1 << 16])
+@pytest.mark.parametrize('layout', [as_array, as_jsonlines, as_concatenated])
+def test_iter_karma_items(layout, chunk_size):
+    assert read_items(layout(ITEMS), chunk_size) == ITEMS
+
+@pytest.mark.parametrize('chunk_size', [1, 5, 1 << 16])
+@pytest.mark.parametrize('text', ['', '   \n', '[]', ' [ ] \n'])
+def test_iter_karma_items_empty(text, chunk_size):
+    assert read_items(text, chunk_size) == []
+
+def test_iter_karma_items_large_item():
+    item = {'@id': 'ad', 'text': 'x' * 100000}
+    assert read_items(as_array([item, item]), 16) == [item, item]
+
+@pytest.mark.parametrize('chunk_size', [1, 4, 1 << 16])
+@pytest.mark.parametrize('text', [
+    '[{"a": 1},]',
+    '[{"a": 1}]garbage',
+    '[{"a": 1}][{"b": 2}]',
+    '[{"a": 1}',
+    '[{"a": 1} {"b": 2}]',
+    '[,{"a": 1}]',
+    '{"a": 1}]',
+    '{"a": 1',
+])
+def test_iter_karma_items_malformed(text, chunk_size):
+    with pytest.raises(ValueError):
+        read_items(text, chunk_size)
+
+def write_indexed_chunk(path, ads):
+    chunk = emf.IndexedChunk(path, [])
+    for adid, attrvals in ads:
+        emf.write_fc(chunk, adid, attrvals, [])
+    chunk.close()
+
+def test_chunk_reader(tmpdir):
+    path = str(tmpdir.join('test.fc'))
+    ads = [(u'ad%d' % i, {'PhoneNumber': [str(i)]}) for i in range(50)]
+    # an adid written again is read back as its last FC
+    ads += [(u'ad7', {'PhoneNumber': ['again']}), (u'caf\xe9', {})]
+    write_indexed_chunk(path, ads)
+    expected = dict(ads)
+    with emf.ChunkReader(path) as reader:
+        assert len(reader) == len(expected)
+        assert sorted(reader) == sorted(expected)
+        for adid, attrvals in expected.iteritems():
+            assert adid in reader
+            assert json.loads(reader[adid]['attrvals']) == attrvals
+        assert u'ad50' not in reader
+        assert reader.get(u'ad50') is None
+        with pytest.raises(KeyError):
+            reader[u'ad50']
+        got = dict(reader.get_many([u'ad3', u'ad7', u'ad50']))
+        assert sorted(got) == [u'ad3', u'ad7']
+        assert (json.loads(got[u'ad7']['attrvals']) ==
+                {'PhoneNumber': ['again']})
+        assert (sorted(adid for adid, fc in reader.iteritems()) ==
+                sorted(expected))
+
+def test_chunk_reader_falls_back_to_index(tmpdir):
+    path = str(tmpdir.join('test.fc'))
+    write_indexed_chunk(path, [(u'ad1', {})])
+    lookup = emf.lookup_path(path, 'lookup.json')
+    with open(lookup) as f:
+        written = f.read()
+    write_indexed_chunk(path, [(u'ad2', {})])
+    # the lookup.json of an earlier size of the chunk
+    with open(lookup, 'w') as f:
+        f.write(written)
+    listed = sorted(os.listdir(emf.lookup_path(path)))
+    with emf.ChunkReader(path) as reader:
+        assert sorted(reader) == [u'ad1', u'ad2']
+    with open(lookup) as f:
+        assert f.read() == written
+    assert sorted(os.listdir(emf.lookup_path(path))) == listed
+
+def test_chunk_reader_survives_new_lookup(tmpdir):
+    path = str(tmpdir.join('test.fc'))
+    write_indexed_chunk(path, [(u'ad%05d' % i, {'n': [str(i)]})
+                               for i in range(100)])
+    with emf.ChunkReader(path) as reader:
+        write_indexed_chunk(path, [(u'ad%05d' % i, {'n': [str(i)]})
+                                   for i in range(100, 300)])
+        assert len(reader) == 100
+        assert json.loads(reader[u'ad00010']['attrvals']) == {'n': ['10']}
+    with emf.ChunkReader(path) as reader:
+        assert len(reader) == 300
+        assert json.loads(reader[u'ad00250']['attrvals']) == {'n': ['250']}
+    # only the current lookup is kept
+    assert len(os.listdir(emf.lookup_path(path))) == 2
+
+def test_chunk_reader_needs_index(tmpdir):
+    path = str(tmpdir.join('test.fc'))
+    write_indexed_chunk(path, [(u'ad1', {})])
+    os.unlink(emf.index_path(path))
+    with pytest.raises(IOError):
+        emf.ChunkReader(path)
+
+def write_incremental(path, ads):
+    '''
+    What --incremental does: writes the FCs of the new or changed ads
+    '''
+    chunk = emf.IndexedChunk(path, [])
+    written = []
+    for adid, attrvals in ads:
+        if not chunk.unchanged(adid, attrvals):
+            emf.write_fc(chunk, adid, attrvals, [])
+            written.append(adid)
+    chunk.close()
+    return written
+
+def test_incremental_and_compact(tmpdir):
+    path = str(tmpdir.join('test.fc'))
+    first = [(u'same', {'age': ['21']}), (u'changed', {'age': ['22']})]
+    assert write_incremental(path, first) == [u'same', u'changed']
+    second = [(u'same', {'age': ['21']}), (u'changed', {'age': ['23']}),
+              (u'new', {'age': ['24']})]
+    assert write_incremental(path, second) == [u'changed', u'new']
+    # the replaced FC of changed stays until compacted
+    assert len(list(FeatureCollectionCborChunk(path=path, mode='rb'))) == 4
+    emf.compact_chunk(path)
+    fcs = list(FeatureCollectionCborChunk(path=path, mode='rb'))
+    assert sorted(fc['adid'] for fc in fcs) == [u'changed', u'new', u'same']
+    with emf.ChunkReader(path) as reader:
+        assert sorted(reader) == [u'changed', u'new', u'same']
+        for adid, attrvals in second:
+            assert json.loads(reader[adid]['attrvals']) == attrvals
+    assert write_incremental(path, second) == []
+
+def test_indexed_chunk_refuses_chunk_without_index(tmpdir):
+    path = str(tmpdir.join('test.fc'))
+    chunk = FeatureCollectionCborChunk(path=path, mode='wb')
+    emf.write_fc(chunk, u'ad1', {}, [])
+    chunk.close()
+    with pytest.raises(IOError):
+        emf.IndexedChunk(path, [])
+
+def test_pipeline_stats():
+    stats = emf.PipelineStats()
+    assert 'p50 <= -us, p99 <= -us' in stats.summary()
+    stats.count_ad({'age': ['21', '21'], 'cup': ['d']}, {'a': 1}, 3e-6)
+    other = emf.PipelineStats()
+    other.count_ad({'age': ['21', '22']}, {'a': 1}, 1e-6)
+    stats.merge(other)
+    report = stats.report()
+    assert report['cardinality'] == {'age': {1: 1, 2: 1}, 'cup': {1: 1}}
+    assert report['mentions'] == 5
+    assert report['ad_latency_us']['histogram'] == {4: 1, 1: 1}
+    assert 'p50 <= 1us, p99 <= 4us' in stats.summary()
+
+LINKED_ADS = [
+    (u'ad1', {'PhoneNumber': ['2135551212', '2135551212'], 'age': ['21']}),
+    (u'ad2', {'PhoneNumber': ['2135551212'], 'PersonName': [u'zo\xe9']}),
+    (u'ad3', {'PersonName': ['a!', 'a'], 'age': ['21']}),
+    (u'ad4', {'age': ['40']}),
+    # again, so its values are added to those above
+    (u'ad1', {'PersonName': ['a'], 'age': ['22']}),
+    (u'caf\xe9', {'PersonName': [u'zo\xe9', 'a!']}),
+]
+
+def test_link_index(tmpdir):
+    path = str(tmpdir.join('test.fc'))
+    writer = emf.LinkIndexWriter()
+    assert list(writer.indexed(iter(LINKED_ADS))) == LINKED_ADS
+    writer.write(path)
+    features = {}
+    for adid, attrvals in LINKED_ADS:
+        for featname, vals in attrvals.iteritems():
+            features.setdefault(adid, set()).update(
+                (featname, featval) for featval in vals)
+    with emf.LinkIndex(path) as links:
+        assert len(links) == len(features)
+        assert u'ad5' not in links
+        assert links.features_of(u'ad5') == []
+        assert links.ads_with('age', '99') == []
+        assert links.linked_ads(u'ad5') == {}
+        for adid, keys in features.iteritems():
+            assert adid in links
+            assert links.features_of(adid) == sorted(keys)
+            for key in keys:
+                assert sorted(links.ads_with(*key)) == sorted(
+                    other for other, other_keys in features.iteritems()
+                    if key in other_keys)
+            expected = {}
+            for other, other_keys in features.iteritems():
+                shared = keys & other_keys
+                if other != adid and shared:
+                    expected[other] = sorted(shared)
+            assert dict((other, sorted(shared)) for other, shared
+                        in links.linked_ads(adid).iteritems()) == expected
+        assert links.linked_ads(u'ad1', featnames=['age']) == \
+            {u'ad3': [(u'age', u'21')]}
+
+@pytest.mark.parametrize('threshold', [0.3, 0.5, 0.6, 0.8, 0.95])
+def test_lsh_bands(threshold):
+    bands, rows = emf.lsh_bands(threshold)
+    assert bands * rows == emf.MINHASH_PERMUTATIONS
+    assert (1 / bands) ** (1 / rows) <= threshold
+    # one more row per band would raise the S-curve threshold above it
+    more = [r for r in range(rows + 1, emf.MINHASH_PERMUTATIONS + 1)
+            if emf.MINHASH_PERMUTATIONS % r == 0]
+    assert all((r / emf.MINHASH_PERMUTATIONS) ** (1 / r) > threshold
+               for r in more)
+
+def test_lsh_bands_below_every_split():
+    assert emf.lsh_bands(0.001) == (emf.MINHASH_PERMUTATIONS, 1)
+
+def near_duplicate_ads(seed=1, groups=30, ads_per_group=4):
+    '''
+    (adid, tokens) of groups of ads sharing most of their tokens
+    '''
+    rng = random.Random(seed)
+    ads = []
+    for group in range(groups):
+        base = set(u'g%d-%d' % (group, i) for i in range(20))
+        for ad in range(ads_per_group):
+            tokens = set(token for token in base if rng.random() < 0.85)
+            tokens.update(u'r%d' % rng.randrange(10000)
+                          for i in range(rng.randrange(4)))
+            ads.append((u'ad-%d-%d' % (group, ad), tokens))
+    # an exact duplicate
+    ads.append((u'copy', set(ads[0][1])))
+    return ads
+
+def write_lsh(path, ads, threshold):
+    writer = emf.LshIndexWriter(path, threshold)
+    for adid, tokens in ads:
+        writer.add(adid, emf.minhash_signature(tokens))
+    writer.close()
+
+def test_lsh_index(tmpdir):
+    path = str(tmpdir.join('lsh'))
+    ads = near_duplicate_ads()
+    write_lsh(path, ads, 0.5)
+    with emf.LshIndex(path) as index:
+        assert len(index) == len(ads)
+        assert index.similar(u'nope') == {}
+        assert index.similar(ads[0][0])[u'copy'] == 1.0
+        similar = set()
+        for adid, tokens in ads:
+            for other, similarity in index.similar(adid).iteritems():
+                assert similarity >= 0.5
+                assert index.similar(other)[adid] == similarity
+                similar.add(frozenset([adid, other]))
+        pairs = [frozenset([a, b]) for a, b, similarity
+                 in index.candidate_pairs()]
+        # each pair once, and the same pairs as similar finds
+        assert len(pairs) == len(set(pairs))
+        assert set(pairs) == similar
+        # most ads of a group are found together
+        assert len(similar) > 30 * 3
+        assert set(frozenset([a, b]) for a, b, similarity
+                   in index.candidate_pairs(max_bucket=1)) == set()
+
+def test_minhash_params():
+    assert emf.minhash_params(20141017) == emf.MINHASH_PARAMS
+    assert len(emf.MINHASH_PARAMS) == emf.MINHASH_PERMUTATIONS
+    assert emf.minhash_params(1, 4) != emf.minhash_params(2, 4)
+
+def write_rolling_and_die(path, adids, compress):
+    chunk = emf.RollingChunk(path, max_fcs=3, compress=compress)
+    for adid in adids:
+        emf.write_fc(chunk, adid, {}, [])
+    # killed before close
+    os._exit(0)
+
+@pytest.mark.parametrize('compress', [False, True])
+def test_rolling_chunk_interrupted(tmpdir, compress):
+    path = str(tmpdir.join('test.fc'))
+    adids = [u'ad%d' % i for i in range(8)]
+    proc = multiprocessing.Process(target=write_rolling_and_die,
+                                   args=(path, adids, compress))
+    proc.start()
+    proc.join()
+    assert proc.exitcode == 0
+    complete = [emf.rolled_path(path, number, compress) for number in [0, 1]]
+    part = emf.rolled_path(path, 2, compress) + '.part'
+    listed = sorted(str(p) for p in tmpdir.listdir())
+    assert listed == sorted(complete + [part])
+    read = [fc['adid'] for chunk_path in complete
+            for fc in FeatureCollectionCborChunk(path=chunk_path, mode='rb')]
+    assert read == adids[:6]
+
+def test_rolling_chunk(tmpdir):
+    path = str(tmpdir.join('test.fc'))
+    chunk = emf.RollingChunk(path, max_fcs=3)
+    for i in range(7):
+        emf.write_fc(chunk, u'ad%d' % i, {}, [])
+    chunk.close()
+    assert chunk.paths == [emf.rolled_path(path, n) for n in range(3)]
+    assert sorted(str(p) for p in tmpdir.listdir()) == chunk.paths
+    with pytest.raises(IOError):
+        emf.write_fc(emf.RollingChunk(path, max_fcs=3), u'ad', {}, [])
+
+class FailingChunk(object):
+    '''
+    A chunk whose add fails from the second FC on
+    '''
+    def __init__(self):
+        self.fcs = []
+        self.closed = False
+
+    def add(self, fc):
+        if self.fcs:
+            raise IOError(errno.ENOSPC, 'no space left')
+        self.fcs.append(fc)
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+def test_background_chunk():
+    chunk = FailingChunk()
+    background = emf.BackgroundChunk(chunk, 2)
+    background.add({'adid': u'ad1'})
+    background.close()
+    assert chunk.fcs == [{'adid': u'ad1'}] and chunk.closed
+
+def test_background_chunk_error_raised_by_add():
+    background = emf.BackgroundChunk(FailingChunk(), 1)
+    background.add({'adid': u'ad1'})
+    background.add({'adid': u'ad2'})
+    background.queue.join()
+    with pytest.raises(IOError):
+        background.add({'adid': u'ad3'})
+    # after the error the queue is drained, so adds do not block
+    background = emf.BackgroundChunk(FailingChunk(), 1)
+    with pytest.raises(IOError):
+        for i in range(100):
+            background.add({'adid': u'ad%d' % i})
+
+def test_background_chunk_error_raised_by_close():
+    background = emf.BackgroundChunk(FailingChunk(), 100)
+    background.add({'adid': u'ad1'})
+    background.add({'adid': u'ad2'})
+    with pytest.raises(IOError):
+        background.close()